@@ -0,0 +1,198 @@
+import json
+import math
+import queue
+import random
+import sys
+import time
+import numpy as np
+import torch
+import torch.multiprocessing as mp
+from game_core.board import Board
+from player.mcts_player import MCTSPlayer
+from player.policy_value_net import PolicyValueNet
+
+
+def play_random_opening(board, n_plies, rng):
+    """
+    Play {n_plies} random legal moves, so that the games of a match don't all follow the same line
+    """
+    for _ in range(n_plies):
+        moves = [(piece_id, coord) for piece_id, coords in board.availables.items() for coord in coords]
+        if not moves:
+            break
+        board.move_piece(*rng.choice(moves))
+        if board.game_finished()[0]:
+            board.init_board(0)  # restart the opening, rare
+    return list(board.all_moves)
+
+
+def arena_worker(worker_id, config, task_queue, result_queue):
+    """
+    Arena worker process: plays the games of the task ids received from {task_queue} between the 2 models,
+    and sends the result of each game back through {result_queue}. A None in {task_queue} stops the worker.
+    """
+    from train import SelfPlayGame  # train imports this module
+    torch.set_num_threads(1)  # one core per worker
+    np.random.seed(config['seed'] + worker_id)
+    players = []
+    for i, model_file in enumerate(config['model_files']):
+        if model_file is not None:
+            # the checkpoint tells the architecture, the 2 models may differ
+            policy_value_net = PolicyValueNet.from_checkpoint(model_file)
+        else:
+            policy_value_net = PolicyValueNet(config['board_height'], config['board_width'],
+                                              config['n_state_channels'], config['n_actions'])
+        players.append(MCTSPlayer(policy_value_net.policy_value_fn, player_id=i, name=f"model{i}", c=config['c_puct'],
+                                  n_simulations=config['n_simulations'], batch_size=config['mcts_batch_size'],
+                                  policy_value_batch_fn=policy_value_net.policy_value_batch_fn))
+    game = SelfPlayGame(config['board_backend'])
+    while True:
+        game_id = task_queue.get()
+        if game_id is None:
+            break
+        # the 2 games of a pair share the opening, with the colors swapped
+        rng = random.Random(config['seed'] + game_id // 2)
+        board = Board(backend=config['board_backend'])
+        board.init_board(0)
+        opening = play_random_opening(board, config['n_opening_plies'], rng)
+        red_model = game_id % 2  # the model playing red (player 0)
+        colored_players = [players[red_model], players[1 - red_model]]
+        for player_id, player in enumerate(colored_players):
+            player.player_id = player_id
+        winner = game.start_eval_play(colored_players, board)
+        result_queue.put({
+            'game_id': game_id,
+            'red_model': red_model,
+            'opening': [[int(piece_id), [int(coord[0]), int(coord[1])]] for piece_id, coord in opening],
+            'winner': int(winner),  # the winning player id, -1: tie
+            'score': 0.5 if winner == -1 else float(winner == red_model),  # the score of model 0 (player id red_model)
+            'n_plies': len(board.all_moves),
+        })
+
+
+def get_match_summary(scores, z=1.96):
+    """
+    Return the win/draw/loss counts of model 0, its mean score with a confidence interval (normal approximation),
+    and the corresponding Elo differences
+    """
+    scores = np.asarray(scores, dtype=float)
+    n_games = len(scores)
+    summary = {
+        'n_games': n_games,
+        'wins': int(np.sum(scores == 1)),
+        'draws': int(np.sum(scores == 0.5)),
+        'losses': int(np.sum(scores == 0)),
+    }
+    if n_games == 0:
+        return summary
+    score = float(np.mean(scores))
+    margin = z * float(np.std(scores)) / math.sqrt(n_games)
+    summary['score'] = score
+    summary['score_ci'] = [max(score - margin, 0.), min(score + margin, 1.)]
+    summary['elo'] = score_to_elo(score)
+    summary['elo_ci'] = [score_to_elo(s) for s in summary['score_ci']]
+    return summary
+
+
+def score_to_elo(score, eps=1e-3):
+    score = min(max(score, eps), 1 - eps)
+    return -400 * math.log10(1 / score - 1)
+
+
+class Arena:
+    def __init__(self, model_file_0, model_file_1, n_games=200, n_workers=4, n_simulations=200, c_puct=5,
+                 mcts_batch_size=8, n_opening_plies=4, results_file=None, board_backend="array", seed=None):
+        """
+        A headless match between 2 model checkpoints (None: a randomly initialized model), played by MCTS players in
+        {n_workers} processes. The games are played in pairs with the same random opening of {n_opening_plies} plies
+        and the colors swapped. The result of each game is appended to {results_file} (jsonl) as soon as it arrives.
+        """
+        self.n_games = n_games
+        self.n_workers = n_workers
+        self.results_file = results_file
+        self.config = {
+            'model_files': [model_file_0, model_file_1],
+            'board_height': 10,
+            'board_width': 9,
+            'n_state_channels': 9,
+            'n_actions': 192,
+            'board_backend': board_backend,
+            'c_puct': c_puct,
+            'n_simulations': n_simulations,
+            'mcts_batch_size': mcts_batch_size,
+            'n_opening_plies': n_opening_plies,
+            'seed': random.randrange(2 ** 31) if seed is None else seed,
+        }
+        self.workers = []
+        self.results = []
+
+    def start(self):
+        """
+        Start the worker processes and return right away, see poll()
+        """
+        ctx = mp.get_context("spawn")
+        self.task_queue = ctx.Queue()
+        self.result_queue = ctx.Queue()
+        for game_id in range(self.n_games):
+            self.task_queue.put(game_id)
+        for worker_id in range(self.n_workers):
+            self.task_queue.put(None)
+            worker = ctx.Process(target=arena_worker, args=(worker_id, self.config, self.task_queue, self.result_queue),
+                                 daemon=True)
+            worker.start()
+            self.workers.append(worker)
+        self.start_time = time.time()
+
+    def poll(self, block=False):
+        """
+        Collect the results of the finished games (waiting for all the games if {block}), return True if the match is over
+        """
+        while len(self.results) < self.n_games:
+            try:
+                result = self.result_queue.get(block=block)
+            except queue.Empty:
+                break
+            self.results.append(result)
+            if self.results_file is not None:
+                with open(self.results_file, 'a') as f:
+                    f.write(json.dumps(result) + '\n')
+        if len(self.results) < self.n_games:
+            return False
+        self.stop()
+        return True
+
+    def stop(self):
+        """
+        Stop the worker processes, dropping the unfinished games
+        """
+        for worker in self.workers:
+            if len(self.results) < self.n_games:
+                worker.terminate()
+            worker.join()
+        self.workers = []
+
+    def run(self):
+        """
+        Play the whole match, return its summary
+        """
+        self.start()
+        self.poll(block=True)
+        return self.get_summary()
+
+    def get_summary(self):
+        """
+        Summary of the games finished so far, from the perspective of model 0
+        """
+        summary = get_match_summary([result['score'] for result in self.results])
+        summary['model_files'] = self.config['model_files']
+        summary['time'] = time.time() - self.start_time
+        return summary
+
+
+if __name__ == '__main__':
+    # python arena.py <model file 0> <model file 1> [n_games] [n_workers] [results file]
+    arena = Arena(sys.argv[1], sys.argv[2],
+                  n_games=int(sys.argv[3]) if len(sys.argv) > 3 else 200,
+                  n_workers=int(sys.argv[4]) if len(sys.argv) > 4 else 4,
+                  results_file=sys.argv[5] if len(sys.argv) > 5 else None)
+    print(json.dumps(arena.run(), indent=2))
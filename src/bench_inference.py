@@ -0,0 +1,77 @@
+import random
+import sys
+import time
+import numpy as np
+from game_core.board import Board
+from player.policy_value_net import PolicyValueNet
+
+
+INFERENCE_MODES = [("float32", True), ("bfloat16", False), ("bfloat16", True), ("int8", False), ("int8", True)]
+
+
+def get_positions(n_positions=512, seed=0):
+    """
+    A fixed set of eval states from random games
+    """
+    rng = random.Random(seed)
+    states = []
+    board = Board()
+    board.init_board(0)
+    while len(states) < n_positions:
+        states.append(board.get_eval_state(board.cur_player))
+        moves = [(piece_id, coord) for piece_id, coords in board.availables.items() for coord in coords]
+        board.move_piece(*rng.choice(moves))
+        if board.game_finished()[0]:
+            board.init_board(0)
+    return np.array(states)
+
+
+def check_accuracy(reference_net, net, states):
+    """
+    Return the mean policy KL divergence and the mean value absolute error of {net} vs {reference_net}
+    """
+    ref_probs, ref_values = reference_net.policy_value(states, inference=True)
+    probs, values = net.policy_value(states, inference=True)
+    kl = np.sum(ref_probs * (np.log(ref_probs + 1e-10) - np.log(probs + 1e-10)), axis=1)
+    return float(np.mean(kl)), float(np.mean(np.abs(ref_values - values)))
+
+
+def measure_latency(net, states, batch_size, min_time=0.5):
+    """
+    Return the mean latency (ms) of a batch of {batch_size} states
+    """
+    batch = states[:batch_size]
+    net.policy_value(batch, inference=True)  # warm up (and build the inference model)
+    n_batches = 0
+    start_time = time.perf_counter()
+    while time.perf_counter() - start_time < min_time:
+        net.policy_value(batch, inference=True)
+        n_batches += 1
+    return (time.perf_counter() - start_time) / n_batches * 1000
+
+
+def run_benchmark(model_file=None, batch_sizes=(1, 4, 16, 64, 256)):
+    """
+    Compare the accuracy (vs the float32 eager model) and the speed of the inference modes of PolicyValueNet
+    """
+    states = get_positions(max(batch_sizes))
+    if model_file is not None:
+        reference_net = PolicyValueNet.from_checkpoint(model_file)
+    else:
+        reference_net = PolicyValueNet(10, 9, 9, 192)
+    policy_param = reference_net.get_policy_param()
+    for inference_dtype, jit in [("float32", False)] + INFERENCE_MODES:
+        net = PolicyValueNet(reference_net.board_height, reference_net.board_width, reference_net.n_state_channels,
+                             reference_net.n_actions, inference_dtype=inference_dtype, jit=jit,
+                             model_config=reference_net.model_config)
+        net.load_policy_param(policy_param)
+        kl, value_mae = check_accuracy(reference_net, net, states)
+        print(f"{inference_dtype}{' jit' if jit else ''}: policy kl: {kl:.2e}, value mae: {value_mae:.2e}")
+        for batch_size in batch_sizes:
+            latency = measure_latency(net, states, batch_size)
+            print(f"  batch size: {batch_size}, latency: {latency:.2f} ms, "
+                  f"positions/sec: {batch_size / latency * 1000:.0f}")
+
+
+if __name__ == '__main__':
+    run_benchmark(*sys.argv[1:2])
@@ -0,0 +1,50 @@
+import sys
+import numpy as np
+from game_core.board import Board
+from player.inference_server import InferenceServer
+from player.mcts_player import MCTS
+from player.policy_value_net import PolicyValueNet
+
+
+def check_visit_counts(mcts, n_simulations):
+    """
+    Check the tree statistics after a search: every simulation is backed up to the root exactly once,
+    all but the first one (which expanded the root) through a child of the root, and no virtual loss is left
+    """
+    root = mcts.root
+    assert root.n_visits == n_simulations, f"root visits {root.n_visits} != {n_simulations} simulations"
+    n_child_visits = sum(child.n_visits for child in root.children.values())
+    assert n_child_visits == n_simulations - 1, f"child visits {n_child_visits} != {n_simulations - 1}"
+    nodes = [root]
+    while nodes:
+        node = nodes.pop()
+        assert node.n_virtual_loss == 0, "virtual loss left in the tree"
+        nodes.extend(node.children.values())
+
+
+def run_benchmark(n_simulations=800, thread_counts=(1, 2, 4, 8), n_repeats=3):
+    """
+    Compare the throughput of the tree-parallel MCTS at different numbers of threads, all the threads
+    sharing one InferenceServer which batches their leaf evaluations
+    """
+    policy_value_net = PolicyValueNet(10, 9, 9, 192)
+    board = Board()
+    board.init_board(0)
+    for n_threads in thread_counts:
+        server = InferenceServer(policy_value_net, max_batch_size=n_threads)
+        server.start()
+        speeds = []
+        for _ in range(n_repeats):
+            mcts = MCTS(server.policy_value_fn, n_simulations=n_simulations, n_threads=n_threads)
+            stats = mcts.search(board, board.cur_player, n_simulations)
+            check_visit_counts(mcts, stats['n_simulations'])
+            speeds.append(stats['simulations_per_sec'])
+        server.stop()
+        histogram = server.get_stats()['batch_size_histogram']
+        mean_batch_size = sum(size * cnt for size, cnt in histogram.items()) / max(sum(histogram.values()), 1)
+        print(f"threads: {n_threads}, simulations/sec: {np.mean(speeds):.1f} (+-{np.std(speeds):.1f}), "
+              f"mean eval batch size: {mean_batch_size:.2f}")
+
+
+if __name__ == '__main__':
+    run_benchmark(*[int(arg) for arg in sys.argv[1:2]])
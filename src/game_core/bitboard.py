@@ -0,0 +1,232 @@
+from game_core.board import Piece, piece_id_to_type, piece_id_to_owner
+
+
+# A bitboard is a 90-bit python int, bit (row * 9 + col) is set if the square (row, col) is occupied.
+# A file-major (transposed) bitboard is also kept for the sliding pieces, bit (col * 10 + row).
+HEIGHT = 10
+WIDTH = 9
+RANK_MASK = (1 << WIDTH) - 1
+FILE_MASK = (1 << HEIGHT) - 1
+
+SOLDIER = Piece.SOLDIER.value
+CANNON = Piece.CANNON.value
+CHARIOT = Piece.CHARIOT.value
+HORSE = Piece.HORSE.value
+ELEPHANT = Piece.ELEPHANT.value
+ADVISOR = Piece.ADVISOR.value
+GENERAL = Piece.GENERAL.value
+
+square_coords = [(sq // WIDTH, sq % WIDTH) for sq in range(HEIGHT * WIDTH)]
+
+
+def square(row, col):
+    return row * WIDTH + col
+
+
+def on_board(row, col):
+    return 0 <= row < HEIGHT and 0 <= col < WIDTH
+
+
+def coords_to_bits(coords):
+    bits = 0
+    for row, col in coords:
+        bits |= 1 << square(row, col)
+    return bits
+
+
+def init_horse_table():
+    """
+    [sq] -> a list of (leg bit, bits of the 2 targets blocked by the leg)
+    """
+    table = []
+    for row, col in square_coords:
+        legs = []
+        for leg, targets in (((0, -1), ((-1, -2), (1, -2))), ((-1, 0), ((-2, -1), (-2, 1))),
+                             ((0, 1), ((-1, 2), (1, 2))), ((1, 0), ((2, -1), (2, 1)))):
+            targets = [(row + dr, col + dc) for dr, dc in targets if on_board(row + dr, col + dc)]
+            if targets:
+                legs.append((1 << square(row + leg[0], col + leg[1]), coords_to_bits(targets)))
+        table.append(legs)
+    return table
+
+
+def init_elephant_table():
+    """
+    [owner][sq] -> a list of (eye bit, target bit), elephants can't cross the river
+    """
+    table = [[], []]
+    for owner, up_min_row, down_max_row in ((0, 7, 7), (1, 2, 2)):
+        for row, col in square_coords:
+            moves = []
+            for dr, dc in ((-1, -1), (-1, 1), (1, -1), (1, 1)):
+                if (dr < 0 and row < up_min_row) or (dr > 0 and row > down_max_row) \
+                        or not on_board(row + 2 * dr, col + 2 * dc):
+                    continue
+                moves.append((1 << square(row + dr, col + dc), 1 << square(row + 2 * dr, col + 2 * dc)))
+            table[owner].append(moves)
+    return table
+
+
+def init_step_table(steps, row_range):
+    """
+    [owner][sq] -> bits of the targets of a piece stepping by {steps} within the rows {row_range[owner]} and the palace columns
+    """
+    table = [[], []]
+    for owner in range(2):
+        min_row, max_row = row_range[owner]
+        for row, col in square_coords:
+            targets = [(row + dr, col + dc) for dr, dc in steps
+                       if min_row <= row + dr <= max_row and 3 <= col + dc <= 5]
+            table[owner].append(coords_to_bits(targets))
+    return table
+
+
+def init_soldier_table():
+    """
+    [owner][sq] -> bits of the targets, soldiers move sideways only after crossing the river
+    """
+    table = [[], []]
+    for owner, forward, crossed in ((0, -1, lambda row: row < 5), (1, 1, lambda row: row > 4)):
+        for row, col in square_coords:
+            targets = [(row + forward, col)]
+            if crossed(row):
+                targets += [(row, col - 1), (row, col + 1)]
+            table[owner].append(coords_to_bits([(r, c) for r, c in targets if on_board(r, c)]))
+    return table
+
+
+def init_slide_table(length):
+    """
+    [pos][occupancy of the line] -> (bits of the chariot targets, bits of the cannon targets) along a line of {length} squares.
+    The targets include the occupied squares (to be filtered by the owner later).
+    """
+    table = []
+    for pos in range(length):
+        entries = []
+        for occ in range(1 << length):
+            chariot, cannon = 0, 0
+            for step in (-1, 1):
+                screen = False
+                i = pos + step
+                while 0 <= i < length:
+                    occupied = occ >> i & 1
+                    if not screen:
+                        chariot |= 1 << i
+                        if occupied:
+                            screen = True
+                        else:
+                            cannon |= 1 << i
+                    elif occupied:
+                        cannon |= 1 << i
+                        break
+                    i += step
+            entries.append((chariot, cannon))
+        table.append(entries)
+    return table
+
+
+def init_file_to_board_table():
+    """
+    [col][bits of a file (bit row)] -> the bits on the board
+    """
+    return [[coords_to_bits([(row, col) for row in range(HEIGHT) if bits >> row & 1]) for bits in range(1 << HEIGHT)]
+            for col in range(WIDTH)]
+
+
+horse_table = init_horse_table()
+elephant_table = init_elephant_table()
+advisor_table = init_step_table(((-1, -1), (-1, 1), (1, -1), (1, 1)), ((7, 9), (0, 2)))
+general_table = init_step_table(((-1, 0), (1, 0), (0, -1), (0, 1)), ((7, 9), (0, 2)))
+soldier_table = init_soldier_table()
+rank_slide_table = init_slide_table(WIDTH)
+file_slide_table = init_slide_table(HEIGHT)
+file_to_board_table = init_file_to_board_table()
+
+
+class Bitboards:
+    def __init__(self, board_state):
+        """
+        Bitboard representation of a board state: per-side and per-piece-type occupancy,
+        and the occupancy of all pieces in rank-major and file-major orders.
+        """
+        self.pieces = [[0] * (len(Piece) + 1) for _ in range(2)]  # [owner][piece type]
+        self.occupied = [0, 0]  # [owner]
+        self.occupied_all = 0
+        self.occupied_all_t = 0  # file-major
+        for row in range(HEIGHT):
+            for col in range(WIDTH):
+                piece_id = board_state[row][col]
+                if piece_id != 0:
+                    self.toggle(piece_id, row, col)
+
+    def toggle(self, piece_id, row, col):
+        """
+        Add or remove a piece at (row, col)
+        """
+        bit = 1 << square(row, col)
+        owner = piece_id_to_owner[piece_id - 1]
+        self.pieces[owner][piece_id_to_type[piece_id - 1]] ^= bit
+        self.occupied[owner] ^= bit
+        self.occupied_all ^= bit
+        self.occupied_all_t ^= 1 << (col * HEIGHT + row)
+
+    def move(self, piece_id, from_coord, to_coord, killed_piece_id):
+        if killed_piece_id != 0:
+            self.toggle(killed_piece_id, *to_coord)
+        self.toggle(piece_id, *from_coord)
+        self.toggle(piece_id, *to_coord)
+
+    def unmove(self, piece_id, from_coord, to_coord, killed_piece_id):
+        self.toggle(piece_id, *to_coord)
+        self.toggle(piece_id, *from_coord)
+        if killed_piece_id != 0:
+            self.toggle(killed_piece_id, *to_coord)
+
+    def get_piece_targets(self, piece_id, coord):
+        """
+        Return the bits of the squares the piece at {coord} can move to (before the flying general check)
+        """
+        row, col = coord
+        sq = square(row, col)
+        piece_type = piece_id_to_type[piece_id - 1]
+        owner = piece_id_to_owner[piece_id - 1]
+        occupied = self.occupied_all
+
+        if piece_type == CHARIOT or piece_type == CANNON:
+            slide = 0 if piece_type == CHARIOT else 1
+            rank_targets = rank_slide_table[col][occupied >> (row * WIDTH) & RANK_MASK][slide]
+            file_targets = file_slide_table[row][self.occupied_all_t >> (col * HEIGHT) & FILE_MASK][slide]
+            targets = (rank_targets << (row * WIDTH)) | file_to_board_table[col][file_targets]
+        elif piece_type == HORSE:
+            targets = 0
+            for leg_bit, leg_targets in horse_table[sq]:
+                if not occupied & leg_bit:
+                    targets |= leg_targets
+        elif piece_type == ELEPHANT:
+            targets = 0
+            for eye_bit, target_bit in elephant_table[owner][sq]:
+                if not occupied & eye_bit:
+                    targets |= target_bit
+        elif piece_type == ADVISOR:
+            targets = advisor_table[owner][sq]
+        elif piece_type == GENERAL:
+            targets = general_table[owner][sq]
+        else:
+            targets = soldier_table[owner][sq]
+        return targets & ~self.occupied[owner]
+
+    def get_piece_target_coords(self, piece_id, coord):
+        return bits_to_coords(self.get_piece_targets(piece_id, coord))
+
+    def __eq__(self, other):
+        return self.pieces == other.pieces and self.occupied == other.occupied \
+            and self.occupied_all == other.occupied_all and self.occupied_all_t == other.occupied_all_t
+
+
+def bits_to_coords(bits):
+    coords = []
+    while bits:
+        lowest_bit = bits & -bits
+        coords.append(square_coords[lowest_bit.bit_length() - 1])
+        bits ^= lowest_bit
+    return coords
@@ -1,6 +1,7 @@
+import random
 import numpy as np
 from enum import Enum
-from collections import defaultdict
+from collections import defaultdict, Counter
 from utils.math import bound
 
 
@@ -22,8 +23,23 @@ piece_id_to_owner = [0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0,
 piece_id_to_chinese_name = ["兵", "兵", "兵", "兵", "兵", "炮", "炮", "車", "馬", "相", "仕", "帅", "仕", "相", "馬", "車",
                             "卒", "卒", "卒", "卒", "卒", "炮", "炮", "車", "馬", "象", "士", "将", "士", "象", "馬", "車"]
 
+piece_id_is_slider = np.array([False] + [t in (Piece.CANNON.value, Piece.CHARIOT.value) for t in piece_id_to_type])  # indexed by piece_id, 0: empty
+
+# lookup tables of the player perspectives, indexed by [player_id][piece_id] (piece_id 0: empty)
+# 1: the type of the player's pieces, 0 otherwise
+player_perspective_table_1 = np.array([[0] + [t if o == p else 0 for t, o in zip(piece_id_to_type, piece_id_to_owner)]
+                                       for p in range(2)])
+# 2: the type of the player's pieces, the negative type of the opponent's pieces
+player_perspective_table_2 = np.array([[0] + [t if o == p else -t for t, o in zip(piece_id_to_type, piece_id_to_owner)]
+                                       for p in range(2)])
+
 piece_id_encoded_move_offset = [0, 4, 8, 12, 16, 20, 54, 88, 122, 130, 134, 138, 142, 146, 150, 158]
 
+# random keys for the zobrist hashing of positions, indexed by [piece_id][row][col]
+_zobrist_rng = random.Random(0x5EED)
+zobrist_piece_keys = [[[_zobrist_rng.getrandbits(64) for _ in range(9)] for _ in range(10)] for _ in range(33)]
+zobrist_player_key = _zobrist_rng.getrandbits(64)  # xor-ed in when black is to move
+
 move_encoding_coord_offset = [
     (0, -1), (-1, 0), (0, 1), (1, 0),  # 1. soldier
     (0, -1), (-1, 0), (0, 1), (1, 0),  # 2. soldier
@@ -55,12 +71,49 @@ move_encoding_coord_offset = [
     (1, 0), (2, 0), (3, 0), (4, 0), (5, 0), (6, 0), (7, 0), (8, 0), (9, 0) # 16. chariot, backward
 ]
 
+n_encoded_moves = len(move_encoding_coord_offset)
+
+# move decoding tables, indexed by encoded move: the piece slot (piece_id - 1 for red, piece_id - 17 for black),
+# and the coordinate offset of the move
+move_decoding_slot = np.searchsorted(piece_id_encoded_move_offset, np.arange(n_encoded_moves), side='right') - 1
+move_decoding_offset = np.array(move_encoding_coord_offset)
+
+# move encoding table, indexed by [piece slot][row offset + 9][col offset + 8], -1: not a valid move
+move_encoding_table = np.full((16, 19, 17), -1)
+move_encoding_table[move_decoding_slot, move_decoding_offset[:, 0] + 9, move_decoding_offset[:, 1] + 8] \
+    = np.arange(n_encoded_moves)
+
+# the piece slot of the left-right mirror image of each piece (the pieces are placed symmetrically at the start),
+# and the encoded move mirroring each encoded move, for data augmentation
+mirror_piece_slot = np.array([4, 3, 2, 1, 0, 6, 5, 15, 14, 13, 12, 11, 10, 9, 8, 7])
+move_mirror_table = move_encoding_table[mirror_piece_slot[move_decoding_slot],
+                                        move_decoding_offset[:, 0] + 9, -move_decoding_offset[:, 1] + 8]
+
 class Board:
-    def __init__(self):
+    def __init__(self, debug=False, backend="array", repetition_rule="perpetual_check"):
+        """
+        backend: the move generation backend, "array" (scans the board state array)
+                 or "bitboard" (precomputed attack tables over bitboards, see game_core/bitboard.py)
+        repetition_rule: how a repeated position is adjudicated, "draw" (always a tie),
+                         "perpetual_check" (the player checking in all his moves of the cycle loses)
+                         or "perpetual_check_chase" (so does the player chasing a piece in all his moves of the cycle)
+        """
         self.height = 10
         self.width = 9
         self.n_steps_to_tie = 40  # if no piece dies in N steps, the game will be consider as a tie
+        self.n_repetitions_to_end = 3  # if a position occurs N times, the game ends (see repetition_rule)
+        self.repetition_rule = repetition_rule
         self.n_prev_states = 4
+        self.debug = debug  # cross-check the incremental availables against a full regeneration after each move
+        self.backend = backend
+        if backend == "bitboard":
+            from game_core.bitboard import Bitboards  # bitboard.py imports the piece tables from this module
+            self.bitboards_class = Bitboards
+        # indices of the planes gathered into the eval state, indexed by [ring head][player_id][player_id == start_player]
+        n = self.n_prev_states
+        self.eval_state_indices = np.array([[[
+            [2 * ((head + i) % n) + (p if j == 0 else 1 - p) for i in range(n) for j in range(2)] + [2 * n + is_start]
+            for is_start in range(2)] for p in range(2)] for head in range(n)])
 
     def init_board(self, start_player):
         self.cur_state = np.array([
@@ -75,237 +128,503 @@ class Board:
             [0, 0, 0, 0, 0, 0, 0, 0, 0],
             [8, 9, 10, 11, 12, 13, 14, 15, 16]
         ])
+        self.bitboards = self.bitboards_class(self.cur_state.tolist()) if self.backend == "bitboard" else None
+        self.piece_coords = [None for _ in range(33)]  # the coordinate of each piece, indexed by piece_id (None: dead)
+        for coord in np.transpose(np.nonzero(self.cur_state)).tolist():
+            self.piece_coords[self.cur_state[tuple(coord)]] = tuple(coord)
         self.prev_states = [None for _ in range(self.n_prev_states)]  # a list of the last {n_prev_states} states (for AlphaZero training purpose)
+        self.zobrist_hash = self.compute_zobrist_hash(self.cur_state, start_player)  # updated incrementally by each move
+        self.prev_hashes = [0 for _ in range(self.n_prev_states)]  # the zobrist hashes of the {prev_states} (0: None)
+        # ring buffer of the feature planes of the {prev_states} from both players' perspectives (planes 2k and 2k+1),
+        # followed by a plane of 0s and a plane of 1s; {eval_planes_head} is the slot of the oldest state
+        self.eval_planes = np.zeros((self.n_prev_states * 2 + 2, self.height, self.width), dtype=np.float32)
+        self.eval_planes[-1] = 1
+        self.eval_planes_head = 0
         self.all_moves = []  # a list of all moves (for replay purpose)
         self.cur_player = start_player
         self.start_player = start_player
         self.players_in_check = [False, False]
-        self.availables = defaultdict(list)  # a dict of all moves the are currently available. key: piece_id, value: coord(tuple(x, y))
+        self.pseudo_availables = defaultdict(list)  # the moves of all pieces, ignoring self-check. key: piece_id, value: coord(tuple(x, y))
+        self.availables = defaultdict(list)  # the legal moves of the player to move. key: piece_id, value: coord(tuple(x, y))
         self.update_availables(self.cur_state)
+        # the history of all positions of the game, for repetition detection
+        self.hash_history = [self.zobrist_hash]
+        self.hash_counts = Counter(self.hash_history)
+        self.check_history = [self.players_in_check[start_player]]  # if the move leading to the position gave check
+        self.chase_history = [False]  # if the move leading to the position chased a piece
         self.n_steps_no_piece_die = 0
+        self.undo_stack = []  # undo records of the moves made by make_move()
 
     def update_availables(self, board_state):
-        self.availables.clear()
-        # Get the coordinates of non-zero elements
-        pieces_coords = np.transpose(np.nonzero(board_state)).tolist()
-        for coord in pieces_coords:
-            new_coords = []
-            piece_id = board_state[tuple(coord)]
-            piece_type = piece_id_to_type[piece_id - 1]
+        """
+        Regenerate the available moves of all pieces from scratch
+        """
+        self.pseudo_availables.clear()
+        self.pseudo_availables.update(self.generate_availables(board_state))
+        self.update_legal_availables()
+
+    def generate_availables(self, board_state):
+        """
+        Return a dict of the pseudo-legal available moves of all pieces on the board (self-check not excluded)
+        """
+        availables = {}
+        for piece_id, coord in enumerate(self.piece_coords):
+            if coord is None:
+                continue
+            moves = self.get_piece_moves(board_state, piece_id, coord)
+            if moves:
+                availables[piece_id] = moves
+        return availables
+
+    def update_availables_incremental(self, piece_id, from_coord, to_coord, killed_piece_id):
+        """
+        Update the pseudo-legal available moves after {piece_id} moved from {from_coord} to {to_coord}.
+        Only the pieces whose moves can be affected by the 2 squares are regenerated:
+        - pieces within 2 rows/cols of the squares (soldiers, horses and their legs, elephants and their eyes,
+          advisors, generals)
+        - chariots and cannons sliding along the rows/cols of the squares
+        - all pieces in the columns of the generals (flying general rule)
+        """
+        board_state = self.cur_state
+        availables_delta = {}  # the replaced availables of the affected pieces (None: no entry), for undo purpose
+        if killed_piece_id != 0:
+            availables_delta[killed_piece_id] = self.pseudo_availables.pop(killed_piece_id, None)
+        mask = np.zeros((self.height, self.width), dtype=bool)
+        for r, c in (from_coord, to_coord):
+            mask[max(r - 2, 0):r + 3, max(c - 2, 0):c + 3] = True
+            mask[r, :] |= piece_id_is_slider[board_state[r, :]]
+            mask[:, c] |= piece_id_is_slider[board_state[:, c]]
+        general_cols = set(coord[1] for coord in (self.piece_coords[12], self.piece_coords[28]) if coord is not None)
+        if piece_id_to_type[piece_id - 1] == Piece.GENERAL.value:
+            general_cols.add(from_coord[1])
+        if killed_piece_id != 0 and piece_id_to_type[killed_piece_id - 1] == Piece.GENERAL.value:
+            general_cols.add(to_coord[1])
+        if from_coord[1] in general_cols or to_coord[1] in general_cols:
+            mask[:, list(general_cols)] = True
+        mask &= board_state != 0
+        for coord in np.transpose(np.nonzero(mask)).tolist():
+            coord = tuple(coord)
+            affected_piece_id = int(board_state[coord])
+            moves = self.get_piece_moves(board_state, affected_piece_id, coord)
+            if moves:
+                old_moves = self.pseudo_availables.get(affected_piece_id)
+                self.pseudo_availables[affected_piece_id] = moves
+            else:
+                old_moves = self.pseudo_availables.pop(affected_piece_id, None)
+            availables_delta.setdefault(affected_piece_id, old_moves)
+        return availables_delta
+
+    def update_legal_availables(self):
+        """
+        Rebuild the legal moves of the player to move from the pseudo-legal moves
+        """
+        in_check = self.check_player_in_check(self.cur_player, self.cur_state)
+        self.players_in_check = [False, False]
+        self.players_in_check[self.cur_player] = in_check
+        self.availables = self.generate_legal_availables(self.cur_player, in_check)
+
+    def generate_legal_availables(self, player, in_check):
+        """
+        Return a dict of the legal moves of the player, i.e. the pseudo-legal moves not leaving his general attacked.
+        If the player is not in check, only the general's moves and the moves from/to the squares found by
+        get_pin_candidates are tested.
+        """
+        general_id = 12 if player == 0 else 28
+        general_coord = self.piece_coords[general_id]
+        availables = defaultdict(list)
+        if general_coord is None:
+            return availables
+        if not in_check:
+            pinned_coords, screen_coords = self.get_pin_candidates(general_coord, 1 - player, self.cur_state)
+        for piece_id, moves in self.pseudo_availables.items():
+            if piece_id_to_owner[piece_id - 1] != player or not moves:
+                continue
+            if in_check or piece_id == general_id or self.piece_coords[piece_id] in pinned_coords:
+                moves = [coord for coord in moves if self.check_move_legal(player, piece_id, coord)]
+            elif screen_coords:
+                moves = [coord for coord in moves
+                         if coord not in screen_coords or self.check_move_legal(player, piece_id, coord)]
+            if moves:
+                availables[piece_id] = moves
+        return availables
+
+    def get_pin_candidates(self, general_coord, attacker, board_state):
+        """
+        Return the squares from which a move may expose the general to the {attacker}:
+        - the 1st piece on a line from the general, with a chariot (or the general, along the column) 2nd or a cannon 3rd
+        - the 2nd piece on a line from the general, with a cannon 3rd
+        - the horse legs blocking the attacker's horses,
+        and the empty squares into which a move may make a cannon screen (between the general and a cannon 1st on a line)
+        """
+        row, col = general_coord
+        pinned_coords, screen_coords = set(), set()
+        for line, pos, is_col in ((board_state[row].tolist(), col, False), (board_state[:, col].tolist(), row, True)):
+            for step in (-1, 1):
+                pieces = []  # (index on the line, piece type if owned by the attacker else 0) of the first 3 pieces
+                i = pos + step
+                while 0 <= i < len(line) and len(pieces) < 3:
+                    piece_id = line[i]
+                    if piece_id != 0:
+                        pieces.append((i, piece_id_to_type[piece_id - 1] if piece_id_to_owner[piece_id - 1] == attacker else 0))
+                    i += step
+                pieces += [(None, 0)] * (3 - len(pieces))
+                types = [piece_type for _, piece_type in pieces]
+                line_coords = [None if i is None else ((i, col) if is_col else (row, i)) for i, _ in pieces]
+                if types[1] == Piece.CHARIOT.value or is_col and types[1] == Piece.GENERAL.value \
+                        or types[2] == Piece.CANNON.value:
+                    pinned_coords.add(line_coords[0])
+                if types[2] == Piece.CANNON.value:
+                    pinned_coords.add(line_coords[1])
+                if types[0] == Piece.CANNON.value:
+                    for i in range(pos + step, pieces[0][0], step):
+                        screen_coords.add((i, col) if is_col else (row, i))
+        for dr, dc in ((-1, -1), (-1, 1), (1, -1), (1, 1)):
+            leg_row, leg_col = row + dr, col + dc
+            if not (0 <= leg_row < self.height and 0 <= leg_col < self.width) or board_state[leg_row, leg_col] == 0:
+                continue
+            for horse_coord in ((leg_row + dr, leg_col), (leg_row, leg_col + dc)):
+                if 0 <= horse_coord[0] < self.height and 0 <= horse_coord[1] < self.width:
+                    piece_id = board_state[horse_coord]
+                    if piece_id != 0 and piece_id_to_owner[piece_id - 1] == attacker \
+                            and piece_id_to_type[piece_id - 1] == Piece.HORSE.value:
+                        pinned_coords.add((leg_row, leg_col))
+        return pinned_coords, screen_coords
+
+    def get_legal_availables(self, player):
+        """
+        Return the legal moves of the player (generated on demand if it's not his turn)
+        """
+        if player == self.cur_player:
+            return self.availables
+        return self.generate_legal_availables(player, self.check_player_in_check(player, self.cur_state))
+
+    def check_availables(self):
+        """
+        Cross-check the incrementally updated availables against a full regeneration, the legal availables against
+        testing every move, and the piece_coords index, the zobrist hash and the bitboards against the board state (debug purpose)
+        """
+        piece_ids = [piece_id for piece_id, coord in enumerate(self.piece_coords) if coord is not None]
+        assert sorted(piece_ids) == sorted(self.cur_state[self.cur_state != 0].tolist()) \
+            and all(self.cur_state[self.piece_coords[piece_id]] == piece_id for piece_id in piece_ids), \
+            f"piece_coords out of sync with the board state: {self.piece_coords}"
+        assert self.zobrist_hash == self.compute_zobrist_hash(self.cur_state, self.cur_player) \
+            and self.zobrist_hash == self.hash_history[-1], "zobrist hash out of sync with the board state"
+        assert self.bitboards is None or self.bitboards == self.bitboards_class(self.cur_state.tolist()), \
+            "bitboards out of sync with the board state"
+        incremental = {piece_id: set(moves) for piece_id, moves in self.pseudo_availables.items() if moves}
+        full = {piece_id: set(moves) for piece_id, moves in self.generate_availables(self.cur_state).items()}
+        assert incremental == full, f"incremental availables mismatch after moves {self.all_moves[-1:]}: " \
+                                    f"incremental={incremental}, full={full}"
+        in_check = self.check_player_in_check(self.cur_player, self.cur_state)
+        assert self.players_in_check[self.cur_player] == in_check, "players_in_check out of sync with the board state"
+        legal = {piece_id: set(moves) for piece_id, moves in self.availables.items() if moves}
+        full = {piece_id: set(moves) for piece_id, moves in
+                self.generate_legal_availables(self.cur_player, in_check=True).items()}  # test every move
+        assert legal == full, f"legal availables mismatch after moves {self.all_moves[-1:]}: legal={legal}, full={full}"
+
+    def get_piece_moves(self, board_state, piece_id, coord):
+        """
+        Return the list of available moves of the piece located at {coord}
+        """
+        if self.bitboards is not None:
             piece_owner = piece_id_to_owner[piece_id - 1]
+            return [new_coord for new_coord in self.bitboards.get_piece_target_coords(piece_id, coord)
+                    if self.check_move_valid(piece_owner, piece_id, new_coord)]
 
-            if piece_type == Piece.SOLDIER.value:
-                if piece_owner == 0:  # red
-                    new_coords += [(bound(coord[0] - 1, 0, self.height - 1), coord[1])] # forward
-                    if coord[0] < 5:  # has crossed the river
-                        new_coords += [
-                            (coord[0], bound(coord[1] - 1, 0, self.width - 1)),  # left
-                            (coord[0], bound(coord[1] + 1, 0, self.width - 1))  # right
-                        ]
-                else:  # black
-                    new_coords += [(bound(coord[0] + 1, 0, self.height - 1), coord[1])]  # forward
-                    if coord[0] > 4:  # has crossed the river
-                        new_coords += [
-                            (coord[0], bound(coord[1] - 1, 0, self.width - 1)),  # left
-                            (coord[0], bound(coord[1] + 1, 0, self.width - 1))  # right
-                        ]
-
-            elif piece_type == Piece.CANNON.value:
-                # left
-                attack_mode = False
-                for i in range(coord[1] - 1, -1, -1):
-                    if not attack_mode:
-                        if board_state[coord[0], i] == 0:
-                            new_coords.append((coord[0], i))
-                        else:
-                            attack_mode = True
-                    else:
-                        if board_state[coord[0], i] != 0:
-                            if piece_id_to_owner[board_state[coord[0], i] - 1] != piece_owner:
-                                new_coords.append((coord[0], i))
-                            break
-                # right
-                attack_mode = False
-                for i in range(coord[1] + 1, 9, 1):
-                    if not attack_mode:
-                        if board_state[coord[0], i] == 0:
-                            new_coords.append((coord[0], i))
-                        else:
-                            attack_mode = True
-                    else:
-                        if board_state[coord[0], i] != 0:
-                            if piece_id_to_owner[board_state[coord[0], i] - 1] != piece_owner:
-                                new_coords.append((coord[0], i))
-                            break
-                # up
-                attack_mode = False
-                for i in range(coord[0] - 1, -1, -1):
-                    if not attack_mode:
-                        if board_state[i, coord[1]] == 0:
-                            new_coords.append((i, coord[1]))
-                        else:
-                            attack_mode = True
-                    else:
-                        if board_state[i, coord[1]] != 0:
-                            if piece_id_to_owner[board_state[i, coord[1]] - 1] != piece_owner:
-                                new_coords.append((i, coord[1]))
-                            break
-                # down
-                attack_mode = False
-                for i in range(coord[0] + 1, 10, 1):
-                    if not attack_mode:
-                        if board_state[i, coord[1]] == 0:
-                            new_coords.append((i, coord[1]))
-                        else:
-                            attack_mode = True
-                    else:
-                        if board_state[i, coord[1]] != 0:
-                            if piece_id_to_owner[board_state[i, coord[1]] - 1] != piece_owner:
-                                new_coords.append((i, coord[1]))
-                            break
+        new_coords = []
+        piece_type = piece_id_to_type[piece_id - 1]
+        piece_owner = piece_id_to_owner[piece_id - 1]
 
-            elif piece_type == Piece.CHARIOT.value:
-                # left
-                for i in range(coord[1] - 1, -1, -1):
+        if piece_type == Piece.SOLDIER.value:
+            if piece_owner == 0:  # red
+                new_coords += [(bound(coord[0] - 1, 0, self.height - 1), coord[1])] # forward
+                if coord[0] < 5:  # has crossed the river
+                    new_coords += [
+                        (coord[0], bound(coord[1] - 1, 0, self.width - 1)),  # left
+                        (coord[0], bound(coord[1] + 1, 0, self.width - 1))  # right
+                    ]
+            else:  # black
+                new_coords += [(bound(coord[0] + 1, 0, self.height - 1), coord[1])]  # forward
+                if coord[0] > 4:  # has crossed the river
+                    new_coords += [
+                        (coord[0], bound(coord[1] - 1, 0, self.width - 1)),  # left
+                        (coord[0], bound(coord[1] + 1, 0, self.width - 1))  # right
+                    ]
+
+        elif piece_type == Piece.CANNON.value:
+            # left
+            attack_mode = False
+            for i in range(coord[1] - 1, -1, -1):
+                if not attack_mode:
                     if board_state[coord[0], i] == 0:
                         new_coords.append((coord[0], i))
                     else:
+                        attack_mode = True
+                else:
+                    if board_state[coord[0], i] != 0:
                         if piece_id_to_owner[board_state[coord[0], i] - 1] != piece_owner:
                             new_coords.append((coord[0], i))
                         break
-                # right
-                for i in range(coord[1] + 1, 9, 1):
+            # right
+            attack_mode = False
+            for i in range(coord[1] + 1, 9, 1):
+                if not attack_mode:
                     if board_state[coord[0], i] == 0:
                         new_coords.append((coord[0], i))
                     else:
+                        attack_mode = True
+                else:
+                    if board_state[coord[0], i] != 0:
                         if piece_id_to_owner[board_state[coord[0], i] - 1] != piece_owner:
                             new_coords.append((coord[0], i))
                         break
-                # up
-                for i in range(coord[0] - 1, -1, -1):
+            # up
+            attack_mode = False
+            for i in range(coord[0] - 1, -1, -1):
+                if not attack_mode:
                     if board_state[i, coord[1]] == 0:
                         new_coords.append((i, coord[1]))
                     else:
+                        attack_mode = True
+                else:
+                    if board_state[i, coord[1]] != 0:
                         if piece_id_to_owner[board_state[i, coord[1]] - 1] != piece_owner:
                             new_coords.append((i, coord[1]))
                         break
-                # down
-                for i in range(coord[0] + 1, 10, 1):
+            # down
+            attack_mode = False
+            for i in range(coord[0] + 1, 10, 1):
+                if not attack_mode:
                     if board_state[i, coord[1]] == 0:
                         new_coords.append((i, coord[1]))
                     else:
+                        attack_mode = True
+                else:
+                    if board_state[i, coord[1]] != 0:
                         if piece_id_to_owner[board_state[i, coord[1]] - 1] != piece_owner:
                             new_coords.append((i, coord[1]))
                         break
 
-            elif piece_type == Piece.HORSE.value:
-                if coord[0] > 0 and coord[1] > 1 and board_state[coord[0], coord[1] - 1] == 0:
-                    new_coords.append((coord[0] - 1, coord[1] - 2)) # up-left 1
-                if coord[0] > 1 and coord[1] > 0 and board_state[coord[0] - 1, coord[1]] == 0:
-                    new_coords.append((coord[0] - 2, coord[1] - 1)) # up-left 2
-                if coord[0] > 0 and coord[1] < 7 and board_state[coord[0], coord[1] + 1] == 0:
-                    new_coords.append((coord[0] - 1, coord[1] + 2)) # up-right 1
-                if coord[0] > 1 and coord[1] < 8 and board_state[coord[0] - 1, coord[1]] == 0:
-                    new_coords.append((coord[0] - 2, coord[1] + 1)) # up-right 2
-                if coord[0] < 9 and coord[1] > 1 and board_state[coord[0], coord[1] - 1] == 0:
-                    new_coords.append((coord[0] + 1, coord[1] - 2)) # down-left 1
-                if coord[0] < 8 and coord[1] > 0 and board_state[coord[0] + 1, coord[1]] == 0:
-                    new_coords.append((coord[0] + 2, coord[1] - 1)) # down-left 2
-                if coord[0] < 9 and coord[1] < 7 and board_state[coord[0], coord[1] + 1] == 0:
-                    new_coords.append((coord[0] + 1, coord[1] + 2)) # down-right 1
-                if coord[0] < 8 and coord[1] < 8 and board_state[coord[0] + 1, coord[1]] == 0:
-                    new_coords.append((coord[0] + 2, coord[1] + 1)) # down-right 2
-
-            elif piece_type == Piece.ELEPHANT.value:
-                if piece_owner == 0:
-                    if coord[0] > 6 and coord[1] > 0 and board_state[coord[0] - 1, coord[1] - 1] == 0:
-                        new_coords.append((coord[0] - 2, coord[1] - 2))  # up-left
-                    if coord[0] > 6 and coord[1] < 8 and board_state[coord[0] - 1, coord[1] + 1] == 0:
-                        new_coords.append((coord[0] - 2, coord[1] + 2))  # up-right
-                    if coord[0] < 8 and coord[1] > 0 and board_state[coord[0] + 1, coord[1] - 1] == 0:
-                        new_coords.append((coord[0] + 2, coord[1] - 2))  # down-left
-                    if coord[0] < 8 and coord[1] < 8 and board_state[coord[0] + 1, coord[1] + 1] == 0:
-                        new_coords.append((coord[0] + 2, coord[1] + 2))  # down-right
+        elif piece_type == Piece.CHARIOT.value:
+            # left
+            for i in range(coord[1] - 1, -1, -1):
+                if board_state[coord[0], i] == 0:
+                    new_coords.append((coord[0], i))
+                else:
+                    if piece_id_to_owner[board_state[coord[0], i] - 1] != piece_owner:
+                        new_coords.append((coord[0], i))
+                    break
+            # right
+            for i in range(coord[1] + 1, 9, 1):
+                if board_state[coord[0], i] == 0:
+                    new_coords.append((coord[0], i))
                 else:
-                    if coord[0] > 1 and coord[1] > 0 and board_state[coord[0] - 1, coord[1] - 1] == 0:
-                        new_coords.append((coord[0] - 2, coord[1] - 2))  # up-left
-                    if coord[0] > 1 and coord[1] < 8 and board_state[coord[0] - 1, coord[1] + 1] == 0:
-                        new_coords.append((coord[0] - 2, coord[1] + 2))  # up-right
-                    if coord[0] < 3 and coord[1] > 0 and board_state[coord[0] + 1, coord[1] - 1] == 0:
-                        new_coords.append((coord[0] + 2, coord[1] - 2))  # down-left
-                    if coord[0] < 3 and coord[1] < 8 and board_state[coord[0] + 1, coord[1] + 1] == 0:
-                        new_coords.append((coord[0] + 2, coord[1] + 2))  # down-right
-            
-            elif piece_type == Piece.ADVISOR.value:
-                if piece_owner == 0:
-                    if coord[0] > 7 and coord[1] > 3:
-                        new_coords.append((coord[0] - 1, coord[1] - 1))  # up-left
-                    if coord[0] > 7 and coord[1] < 5:
-                        new_coords.append((coord[0] - 1, coord[1] + 1))  # up-right
-                    if coord[0] < 9 and coord[1] > 3:
-                        new_coords.append((coord[0] + 1, coord[1] - 1))  # down-left
-                    if coord[0] < 9 and coord[1] < 5:
-                        new_coords.append((coord[0] + 1, coord[1] + 1))  # down-right
+                    if piece_id_to_owner[board_state[coord[0], i] - 1] != piece_owner:
+                        new_coords.append((coord[0], i))
+                    break
+            # up
+            for i in range(coord[0] - 1, -1, -1):
+                if board_state[i, coord[1]] == 0:
+                    new_coords.append((i, coord[1]))
                 else:
-                    if coord[0] > 0 and coord[1] > 3:
-                        new_coords.append((coord[0] - 1, coord[1] - 1))  # up-left
-                    if coord[0] > 0 and coord[1] < 5:
-                        new_coords.append((coord[0] - 1, coord[1] + 1))  # up-right
-                    if coord[0] < 2 and coord[1] > 3:
-                        new_coords.append((coord[0] + 1, coord[1] - 1))  # down-left
-                    if coord[0] < 2 and coord[1] < 5:
-                        new_coords.append((coord[0] + 1, coord[1] + 1))  # down-right
-            
-            elif piece_type == Piece.GENERAL.value:
-                if piece_owner == 0:
-                    if coord[0] > 7:
-                        new_coords.append((coord[0] - 1, coord[1]))  # forward
-                    if coord[0] < 9:
-                        new_coords.append((coord[0] + 1, coord[1]))  # backward
-                    if coord[1] > 3:
-                        new_coords.append((coord[0], coord[1] - 1))  # left
-                    if coord[1] < 5:
-                        new_coords.append((coord[0], coord[1] + 1))  # right
+                    if piece_id_to_owner[board_state[i, coord[1]] - 1] != piece_owner:
+                        new_coords.append((i, coord[1]))
+                    break
+            # down
+            for i in range(coord[0] + 1, 10, 1):
+                if board_state[i, coord[1]] == 0:
+                    new_coords.append((i, coord[1]))
                 else:
-                    if coord[0] > 0:
-                        new_coords.append((coord[0] - 1, coord[1]))  # backward
-                    if coord[0] < 2:
-                        new_coords.append((coord[0] + 1, coord[1]))  # forward
-                    if coord[1] > 3:
-                        new_coords.append((coord[0], coord[1] - 1))  # left
-                    if coord[1] < 5:
-                        new_coords.append((coord[0], coord[1] + 1))  # right
-
-            for new_coord in new_coords:
-                if (board_state[new_coord] == 0 or piece_id_to_owner[board_state[new_coord] - 1] != piece_owner) \
-                        and coord != new_coord and self.check_move_valid(piece_owner, piece_id, new_coord):
-                    self.availables[piece_id].append(new_coord)
+                    if piece_id_to_owner[board_state[i, coord[1]] - 1] != piece_owner:
+                        new_coords.append((i, coord[1]))
+                    break
+
+        elif piece_type == Piece.HORSE.value:
+            if coord[0] > 0 and coord[1] > 1 and board_state[coord[0], coord[1] - 1] == 0:
+                new_coords.append((coord[0] - 1, coord[1] - 2)) # up-left 1
+            if coord[0] > 1 and coord[1] > 0 and board_state[coord[0] - 1, coord[1]] == 0:
+                new_coords.append((coord[0] - 2, coord[1] - 1)) # up-left 2
+            if coord[0] > 0 and coord[1] < 7 and board_state[coord[0], coord[1] + 1] == 0:
+                new_coords.append((coord[0] - 1, coord[1] + 2)) # up-right 1
+            if coord[0] > 1 and coord[1] < 8 and board_state[coord[0] - 1, coord[1]] == 0:
+                new_coords.append((coord[0] - 2, coord[1] + 1)) # up-right 2
+            if coord[0] < 9 and coord[1] > 1 and board_state[coord[0], coord[1] - 1] == 0:
+                new_coords.append((coord[0] + 1, coord[1] - 2)) # down-left 1
+            if coord[0] < 8 and coord[1] > 0 and board_state[coord[0] + 1, coord[1]] == 0:
+                new_coords.append((coord[0] + 2, coord[1] - 1)) # down-left 2
+            if coord[0] < 9 and coord[1] < 7 and board_state[coord[0], coord[1] + 1] == 0:
+                new_coords.append((coord[0] + 1, coord[1] + 2)) # down-right 1
+            if coord[0] < 8 and coord[1] < 8 and board_state[coord[0] + 1, coord[1]] == 0:
+                new_coords.append((coord[0] + 2, coord[1] + 1)) # down-right 2
+
+        elif piece_type == Piece.ELEPHANT.value:
+            if piece_owner == 0:
+                if coord[0] > 6 and coord[1] > 0 and board_state[coord[0] - 1, coord[1] - 1] == 0:
+                    new_coords.append((coord[0] - 2, coord[1] - 2))  # up-left
+                if coord[0] > 6 and coord[1] < 8 and board_state[coord[0] - 1, coord[1] + 1] == 0:
+                    new_coords.append((coord[0] - 2, coord[1] + 2))  # up-right
+                if coord[0] < 8 and coord[1] > 0 and board_state[coord[0] + 1, coord[1] - 1] == 0:
+                    new_coords.append((coord[0] + 2, coord[1] - 2))  # down-left
+                if coord[0] < 8 and coord[1] < 8 and board_state[coord[0] + 1, coord[1] + 1] == 0:
+                    new_coords.append((coord[0] + 2, coord[1] + 2))  # down-right
+            else:
+                if coord[0] > 1 and coord[1] > 0 and board_state[coord[0] - 1, coord[1] - 1] == 0:
+                    new_coords.append((coord[0] - 2, coord[1] - 2))  # up-left
+                if coord[0] > 1 and coord[1] < 8 and board_state[coord[0] - 1, coord[1] + 1] == 0:
+                    new_coords.append((coord[0] - 2, coord[1] + 2))  # up-right
+                if coord[0] < 3 and coord[1] > 0 and board_state[coord[0] + 1, coord[1] - 1] == 0:
+                    new_coords.append((coord[0] + 2, coord[1] - 2))  # down-left
+                if coord[0] < 3 and coord[1] < 8 and board_state[coord[0] + 1, coord[1] + 1] == 0:
+                    new_coords.append((coord[0] + 2, coord[1] + 2))  # down-right
+        
+        elif piece_type == Piece.ADVISOR.value:
+            if piece_owner == 0:
+                if coord[0] > 7 and coord[1] > 3:
+                    new_coords.append((coord[0] - 1, coord[1] - 1))  # up-left
+                if coord[0] > 7 and coord[1] < 5:
+                    new_coords.append((coord[0] - 1, coord[1] + 1))  # up-right
+                if coord[0] < 9 and coord[1] > 3:
+                    new_coords.append((coord[0] + 1, coord[1] - 1))  # down-left
+                if coord[0] < 9 and coord[1] < 5:
+                    new_coords.append((coord[0] + 1, coord[1] + 1))  # down-right
+            else:
+                if coord[0] > 0 and coord[1] > 3:
+                    new_coords.append((coord[0] - 1, coord[1] - 1))  # up-left
+                if coord[0] > 0 and coord[1] < 5:
+                    new_coords.append((coord[0] - 1, coord[1] + 1))  # up-right
+                if coord[0] < 2 and coord[1] > 3:
+                    new_coords.append((coord[0] + 1, coord[1] - 1))  # down-left
+                if coord[0] < 2 and coord[1] < 5:
+                    new_coords.append((coord[0] + 1, coord[1] + 1))  # down-right
+        
+        elif piece_type == Piece.GENERAL.value:
+            if piece_owner == 0:
+                if coord[0] > 7:
+                    new_coords.append((coord[0] - 1, coord[1]))  # forward
+                if coord[0] < 9:
+                    new_coords.append((coord[0] + 1, coord[1]))  # backward
+                if coord[1] > 3:
+                    new_coords.append((coord[0], coord[1] - 1))  # left
+                if coord[1] < 5:
+                    new_coords.append((coord[0], coord[1] + 1))  # right
+            else:
+                if coord[0] > 0:
+                    new_coords.append((coord[0] - 1, coord[1]))  # backward
+                if coord[0] < 2:
+                    new_coords.append((coord[0] + 1, coord[1]))  # forward
+                if coord[1] > 3:
+                    new_coords.append((coord[0], coord[1] - 1))  # left
+                if coord[1] < 5:
+                    new_coords.append((coord[0], coord[1] + 1))  # right
+
+        moves = []
+        for new_coord in new_coords:
+            if (board_state[new_coord] == 0 or piece_id_to_owner[board_state[new_coord] - 1] != piece_owner) \
+                    and coord != new_coord and self.check_move_valid(piece_owner, piece_id, new_coord):
+                moves.append(new_coord)
+        return moves
 
     def check_move_valid(self, player, piece_id, coord):
         """
-        Check if a move by the player will cause himself be in check
+        Check if a move by the player doesn't make the 2 generals face each other
+        (the other self-checks are excluded from the legal moves by check_move_legal)
+        """
+        return not self.check_generals_meet(piece_id, coord)
+
+    def check_move_legal(self, player, piece_id, coord):
+        """
+        Check if a pseudo-legal move by the player doesn't leave his general attacked
+        """
+        board_state = self.cur_state
+        general_id = 12 if player == 0 else 28
+        from_coord = self.piece_coords[piece_id]
+        general_coord = coord if piece_id == general_id else self.piece_coords[general_id]
+        # try the move on the board state in place, and take it back
+        killed_piece_id = board_state[coord]
+        board_state[from_coord] = 0
+        board_state[coord] = piece_id
+        attacked = self.check_general_attacked(general_coord, 1 - player, board_state)
+        board_state[coord] = killed_piece_id
+        board_state[from_coord] = piece_id
+        return not attacked
+
+    def check_general_attacked(self, coord, attacker, board_state):
         """
-        state = self.cur_state.copy()
-        state[np.where(self.cur_state == piece_id)] = 0
-        state[coord] = piece_id
-        return not self.check_generals_meet(state) \
-            # and not self.check_player_in_check(player, state) 
+        Check if the general at {coord} is attacked by any piece of the {attacker}.
+        Looks outwards from the general's square (chariot, cannon and flying general lines, horse legs, soldier steps)
+        instead of generating all the attacker's moves.
+        """
+        row, col = coord
+        # chariots and cannons along the row and the column, and the general along the column
+        for line, pos, is_col in ((board_state[row].tolist(), col, False), (board_state[:, col].tolist(), row, True)):
+            for step in (-1, 1):
+                n_screens = 0
+                i = pos + step
+                while 0 <= i < len(line):
+                    piece_id = line[i]
+                    if piece_id != 0:
+                        if piece_id_to_owner[piece_id - 1] == attacker:
+                            piece_type = piece_id_to_type[piece_id - 1]
+                            if n_screens == 0 and (piece_type == Piece.CHARIOT.value
+                                                   or is_col and piece_type == Piece.GENERAL.value):
+                                return True
+                            if n_screens == 1 and piece_type == Piece.CANNON.value:
+                                return True
+                        n_screens += 1
+                        if n_screens == 2:
+                            break
+                    i += step
+        # horses, the leg of a horse attacking the general is diagonal to the general
+        for dr, dc in ((-1, -1), (-1, 1), (1, -1), (1, 1)):
+            leg_row, leg_col = row + dr, col + dc
+            if not (0 <= leg_row < self.height and 0 <= leg_col < self.width) or board_state[leg_row, leg_col] != 0:
+                continue
+            for horse_coord in ((leg_row + dr, leg_col), (leg_row, leg_col + dc)):
+                if 0 <= horse_coord[0] < self.height and 0 <= horse_coord[1] < self.width:
+                    piece_id = board_state[horse_coord]
+                    if piece_id != 0 and piece_id_to_owner[piece_id - 1] == attacker \
+                            and piece_id_to_type[piece_id - 1] == Piece.HORSE.value:
+                        return True
+        # soldiers, moving forward, or sideways after crossing the river
+        if attacker == 0:
+            soldier_coords = [(row + 1, col)] + ([(row, col - 1), (row, col + 1)] if row < 5 else [])
+        else:
+            soldier_coords = [(row - 1, col)] + ([(row, col - 1), (row, col + 1)] if row > 4 else [])
+        for soldier_coord in soldier_coords:
+            if 0 <= soldier_coord[0] < self.height and 0 <= soldier_coord[1] < self.width:
+                piece_id = board_state[soldier_coord]
+                if piece_id != 0 and piece_id_to_owner[piece_id - 1] == attacker \
+                        and piece_id_to_type[piece_id - 1] == Piece.SOLDIER.value:
+                    return True
+        return False
 
-    def check_generals_meet(self, board_state):
+    def check_generals_meet(self, piece_id=0, coord=None):
         """
         Check if 2 generals are in the same column and there are no other pieces in between
+        (after moving {piece_id} to {coord}, if given)
         """
-        red_general_pos = np.where(board_state == 12)
-        if len(red_general_pos[0]) == 0:
-            return False
-        black_general_pos = np.where(board_state == 28)
-        if len(black_general_pos[0]) == 0:
+        red_general_coord = self.piece_coords[12]
+        black_general_coord = self.piece_coords[28]
+        if piece_id == 12:
+            red_general_coord = coord
+        elif piece_id == 28:
+            black_general_coord = coord
+        if red_general_coord is None or black_general_coord is None:
             return False
-        if red_general_pos[1][0] != black_general_pos[1][0]:  # 2 generals not in the same column
+        if coord == red_general_coord and piece_id != 12 or coord == black_general_coord and piece_id != 28:
+            return False  # one general is killed by the move
+        col = red_general_coord[1]
+        if col != black_general_coord[1]:  # 2 generals not in the same column
             return False
-        if np.sum(board_state[black_general_pos[0][0]+1:red_general_pos[0][0], red_general_pos[1][0]]) == 0:  # only 2 generals in the same column
-            return True
-        return False
+        top, bottom = black_general_coord[0], red_general_coord[0]
+        n_pieces_between = np.count_nonzero(self.cur_state[top + 1:bottom, col])
+        if piece_id != 0:
+            from_coord = self.piece_coords[piece_id]
+            if from_coord[1] == col and top < from_coord[0] < bottom:
+                n_pieces_between -= 1  # the piece leaves the column
+            if coord[1] == col and top < coord[0] < bottom and self.cur_state[coord] == 0:
+                n_pieces_between += 1  # the piece enters the column
+        return n_pieces_between == 0  # only 2 generals in the same column
     
     def check_player_in_check(self, player, board_state):
         """
@@ -315,29 +634,23 @@ class Board:
             general_piece_id = 12
         else:
             general_piece_id = 28
-        general_coord = tuple(np.transpose(np.where(board_state == general_piece_id))[0])
+        general_coord = self.piece_coords[general_piece_id]
         # check if the player's general is in the attack range of any opponent's piece
-        for piece_id, moves in self.availables.items():
-            if piece_id_to_owner[piece_id - 1] == 1 - player:
-                if general_coord in moves:
-                    return True
-        return False
+        return general_coord is not None and self.check_general_attacked(general_coord, 1 - player, board_state)
     
     def check_player_checkmate(self, player, board_state):
         """
         Check if a player is checkmate
         """
-        # TODO: implement
-        pass
+        return self.check_player_in_check(player, board_state) and self.check_stalement(player)
 
     def check_stalement(self, player):
         """
         Check if a player has no legal move
         """
-        for piece_id, moves in self.availables.items():
-            if piece_id_to_owner[piece_id - 1] == player:
-                if len(moves) > 0:
-                    return False
+        for moves in self.get_legal_availables(player).values():
+            if len(moves) > 0:
+                return False
         return True
 
     def check_move_available(self, piece_id, coord):
@@ -350,42 +663,190 @@ class Board:
         return valid
     
     def move_piece(self, piece_id, coord):
+        self.apply_move(piece_id, coord)
+
+    def make_move(self, piece_id, coord):
+        """
+        Move a piece and push an undo record, so that the move can be taken back with unmake_move().
+        Used by the tree search to descend and rewind the same board in place instead of copying it.
+        """
+        self.undo_stack.append(self.apply_move(piece_id, coord))
+
+    def unmake_move(self):
+        """
+        Take back the last move made by make_move()
+        """
+        piece_id, from_coord, to_coord, killed_piece_id, n_steps_no_piece_die, evicted_state, evicted_hash, \
+            availables_delta, availables, players_in_check = self.undo_stack.pop()
+        # drop the position from the history
+        self.hash_counts[self.hash_history.pop()] -= 1
+        self.check_history.pop()
+        self.chase_history.pop()
+        self.piece_coords[piece_id] = from_coord
+        if killed_piece_id != 0:
+            self.piece_coords[killed_piece_id] = to_coord
+        # switch the player back
+        self.cur_player = 1 - self.cur_player
+        # restore the available moves
+        for affected_piece_id, moves in availables_delta.items():
+            if moves is None:
+                self.pseudo_availables.pop(affected_piece_id, None)
+            else:
+                self.pseudo_availables[affected_piece_id] = moves
+        self.availables = availables
+        self.players_in_check = players_in_check
+        # restore the previous states
+        self.prev_states.pop()
+        self.prev_states.insert(0, evicted_state)
+        self.prev_hashes.pop()
+        self.prev_hashes.insert(0, evicted_hash)
+        self.eval_planes_head = (self.eval_planes_head - 1) % self.n_prev_states
+        self.set_eval_planes(self.eval_planes_head, evicted_state)
+        self.update_zobrist_hash(piece_id, from_coord, to_coord, killed_piece_id)
+        self.all_moves.pop()
+        # restore the board state
+        self.cur_state[to_coord] = killed_piece_id
+        self.cur_state[from_coord] = piece_id
+        if self.bitboards is not None:
+            self.bitboards.unmove(piece_id, from_coord, to_coord, killed_piece_id)
+        self.n_steps_no_piece_die = n_steps_no_piece_die
+        if self.debug:
+            self.check_availables()
+
+    def apply_move(self, piece_id, coord):
+        """
+        Move a piece and return the undo record of the move
+        """
+        n_steps_no_piece_die = self.n_steps_no_piece_die
         # update n_steps_no_piece_die
         if self.cur_state[coord] == 0:
             self.n_steps_no_piece_die += 1
         else:
             self.n_steps_no_piece_die = 0
         # update the board state
-        self.cur_state[np.where(self.cur_state == piece_id)] = 0
+        from_coord = self.piece_coords[piece_id]
+        killed_piece_id = int(self.cur_state[coord])
+        self.cur_state[from_coord] = 0
         self.cur_state[coord] = piece_id
+        self.piece_coords[piece_id] = coord
+        if killed_piece_id != 0:
+            self.piece_coords[killed_piece_id] = None
+        if self.bitboards is not None:
+            self.bitboards.move(piece_id, from_coord, coord, killed_piece_id)
         # keep track of the move
         self.all_moves.append((piece_id, coord))
         # keep track of the {n_prev_states} previous moves
         self.prev_states.append(self.cur_state.copy())
-        self.prev_states.pop(0)
+        evicted_state = self.prev_states.pop(0)
+        self.update_zobrist_hash(piece_id, from_coord, coord, killed_piece_id)
+        self.prev_hashes.append(self.zobrist_hash)
+        evicted_hash = self.prev_hashes.pop(0)
+        self.set_eval_planes(self.eval_planes_head, self.cur_state)
+        self.eval_planes_head = (self.eval_planes_head + 1) % self.n_prev_states
         # update the available moves
-        self.update_availables(self.cur_state)
+        availables_delta = self.update_availables_incremental(piece_id, from_coord, coord, killed_piece_id)
+        availables, players_in_check = self.availables, self.players_in_check
         # switch the player
         self.cur_player = 1 - self.cur_player
+        self.update_legal_availables()
+        # keep track of the position for repetition detection
+        self.hash_history.append(self.zobrist_hash)
+        self.hash_counts[self.zobrist_hash] += 1
+        self.check_history.append(self.players_in_check[self.cur_player])
+        self.chase_history.append(self.repetition_rule == "perpetual_check_chase"
+                                  and self.check_move_chases(piece_id, coord, killed_piece_id, availables_delta.get(piece_id)))
+        if self.debug:
+            self.check_availables()
+        return piece_id, from_coord, coord, killed_piece_id, n_steps_no_piece_die, evicted_state, evicted_hash, \
+            availables_delta, availables, players_in_check
+
+    def update_zobrist_hash(self, piece_id, from_coord, to_coord, killed_piece_id):
+        """
+        Update the zobrist hash with a move (or take it back, as xor is its own inverse)
+        """
+        self.zobrist_hash ^= zobrist_piece_keys[piece_id][from_coord[0]][from_coord[1]] \
+            ^ zobrist_piece_keys[piece_id][to_coord[0]][to_coord[1]] ^ zobrist_player_key
+        if killed_piece_id != 0:
+            self.zobrist_hash ^= zobrist_piece_keys[killed_piece_id][to_coord[0]][to_coord[1]]
+
+    def compute_zobrist_hash(self, board_state, player_id):
+        """
+        Compute the zobrist hash of a board state with {player_id} to move from scratch
+        """
+        h = zobrist_player_key if player_id == 1 else 0
+        for coord in np.transpose(np.nonzero(board_state)).tolist():
+            h ^= zobrist_piece_keys[board_state[tuple(coord)]][coord[0]][coord[1]]
+        return h
 
-    def game_finished(self):
-
-        # p1_in_check = self.check_player_in_check(0, self.cur_state)
-        # p2_in_check = self.check_player_in_check(1, self.cur_state)
-        # # print(f"Player1 checked: {p1_in_check}, Player2 checked: {p2_in_check}")
-        # # check p1
-        # if p1_in_check and (self.players_in_check[0] or self.cur_player == 1):
-        #     return True, 1
-        # self.players_in_check[0] = p1_in_check
-        # # check p2
-        # if p2_in_check and (self.players_in_check[1] or self.cur_player == 0):
-        #     return True, 0
-        # self.players_in_check[1] = p2_in_check
-
-        if 28 not in self.cur_state:
+    def check_move_chases(self, piece_id, to_coord, killed_piece_id, old_moves):
+        """
+        Check if the move of {piece_id} to {to_coord} chases a piece, i.e. the piece now attacks an opponent's piece
+        (other than the general and soldiers) it didn't attack before the move, given its moves before the move.
+        Simplified: whether the chased piece is protected is not considered.
+        """
+        def get_chased_piece_ids(moves, killed_coord):
+            chased_piece_ids = set()
+            for coord in moves or []:
+                target_id = killed_piece_id if coord == killed_coord else self.cur_state[coord]
+                if target_id != 0 and piece_id_to_owner[target_id - 1] != piece_id_to_owner[piece_id - 1] \
+                        and piece_id_to_type[target_id - 1] not in (Piece.GENERAL.value, Piece.SOLDIER.value):
+                    chased_piece_ids.add(target_id)
+            return chased_piece_ids
+        return len(get_chased_piece_ids(self.pseudo_availables.get(piece_id), None)
+                   - get_chased_piece_ids(old_moves, to_coord)) > 0
+
+    def check_repetition(self, n_repetitions):
+        """
+        Check if the current position occurred {n_repetitions} times, and adjudicate the cycle of moves since its
+        previous occurrence with the repetition_rule
+        return: (repeated, winner), winner -1: tie
+        """
+        if self.hash_counts[self.zobrist_hash] < n_repetitions:
+            return False, -1
+        end = len(self.hash_history) - 1
+        start = end - 2  # the same position is reached with the same player to move, 2k plies before
+        while self.hash_history[start] != self.zobrist_hash:
+            start -= 2
+        if self.repetition_rule == "draw":
+            return True, -1
+        last_player = 1 - self.cur_player
+        histories = [self.check_history]
+        if self.repetition_rule == "perpetual_check_chase":
+            histories.append(self.chase_history)
+        for history in histories:
+            # the positions reached by the moves of the last player are end, end - 2, ..., start + 2
+            last_player_perpetual = all(history[start + 2:end + 1:2])
+            cur_player_perpetual = all(history[start + 1:end + 1:2])
+            if last_player_perpetual and not cur_player_perpetual:
+                return True, self.cur_player
+            if cur_player_perpetual and not last_player_perpetual:
+                return True, last_player
+            if last_player_perpetual:
+                return True, -1  # both perpetual
+        return True, -1
+
+    def get_eval_key(self, player_id):
+        """
+        return a key identifying the eval state of the player (the current position and the history the network sees)
+        """
+        return self.zobrist_hash, tuple(self.prev_hashes), player_id, player_id == self.start_player
+
+    def game_finished(self, n_repetitions=None):
+        """
+        n_repetitions: num of occurrences of a position ending the game, default: n_repetitions_to_end
+        return: (finished, winner), winner -1: tie
+        """
+        if self.piece_coords[28] is None:
             return True, 0
-        if 12 not in self.cur_state:
+        if self.piece_coords[12] is None:
             return True, 1
+        # the player to move loses if he has no legal move (checkmate or stalemate)
+        if self.check_stalement(self.cur_player):
+            return True, 1 - self.cur_player
+        # check repetition
+        repeated, winner = self.check_repetition(n_repetitions or self.n_repetitions_to_end)
+        if repeated:
+            return True, winner
         # check tie
         if self.n_steps_no_piece_die == self.n_steps_to_tie:
             return True, -1
@@ -396,86 +857,79 @@ class Board:
         return coord[0] * self.width + coord[1]
     
     ### For AlphaZero evaluation purposes ###
-    def get_eval_state(self, player_id):
+    def get_eval_state(self, player_id, out=None):
         """
         return the board state from the perspective of the player.
+        The planes are computed once per move, so this is a single gather from the ring buffer
+        (into {out} if given, e.g. a row of a preallocated batch).
         """
-        eval_state = np.zeros((self.n_prev_states * 2 + 1, self.height, self.width))
-        for i, state in enumerate(self.prev_states):
-            if state is not None:
-                eval_state[i * 2, :, :] = board_state_to_player_perspective_1(state, player_id)
-                eval_state[i * 2 + 1, :, :] = board_state_to_player_perspective_1(state, 1 - player_id)
-        if player_id == self.start_player:
-            eval_state[-1, :, :] = 1
-        return eval_state
+        indices = self.eval_state_indices[self.eval_planes_head, player_id, int(player_id == self.start_player)]
+        return np.take(self.eval_planes, indices, axis=0, out=out)
+
+    def set_eval_planes(self, slot, board_state):
+        """
+        Compute the feature planes of a state (None: no state) from both players' perspectives into a slot of the ring buffer
+        """
+        if board_state is None:
+            self.eval_planes[2 * slot:2 * slot + 2] = 0
+        else:
+            self.eval_planes[2 * slot:2 * slot + 2] = player_perspective_table_1[:, board_state]
     
     def get_player_encoded_availables(self, player_id):
         """
-        return the encoded availables moves of the player in numeric values
+        return the encoded availables moves of the player as a 0/1 mask over all encoded moves
         """
-        encoded_moves = [0 for _ in range(192)]
-        for piece_id, coords in self.availables.items():
-            if piece_id_to_owner[piece_id - 1] == player_id:
-                for coord in coords:
-                    encoded_move = self.encode_move(piece_id, coord)
-                    encoded_moves[encoded_move] = 1
+        encoded_moves = np.zeros(n_encoded_moves, dtype=np.int8)
+        encoded_moves[self.get_player_encoded_moves(player_id)] = 1
         return encoded_moves
-    
+
+    def get_player_encoded_moves(self, player_id):
+        """
+        return the encoded availables moves of the player, encoded in one shot with the move encoding table
+        """
+        piece_ids, coords = [], []
+        for piece_id, moves in self.get_legal_availables(player_id).items():
+            piece_ids += [piece_id] * len(moves)
+            coords += moves
+        if not coords:
+            return np.zeros(0, dtype=np.int64)
+        piece_ids = np.array(piece_ids)
+        from_coords = np.array([self.piece_coords[piece_id] for piece_id in piece_ids])
+        coord_offsets = np.array(coords) - from_coords
+        return move_encoding_table[(piece_ids - 1) % 16, coord_offsets[:, 0] + 9, coord_offsets[:, 1] + 8]
+
     def decode_move(self, move, player_id):
-        piece_id = np.searchsorted(piece_id_encoded_move_offset, move, side='right')
-        if player_id == 1:
-            piece_id += 16
-        coord = tuple(np.transpose(np.where(self.cur_state == piece_id))[0])
+        piece_id = int(move_decoding_slot[move]) + 1 + 16 * player_id
+        coord = self.piece_coords[piece_id]
         coord_offset = move_encoding_coord_offset[move]
         coord = (coord[0] + coord_offset[0], coord[1] + coord_offset[1])
         return piece_id, coord
 
+    def decode_moves(self, moves, player_id):
+        """
+        decode a batch of encoded moves
+        return: an array of piece ids, an array of the (row, col) coordinates the pieces move to
+        """
+        moves = np.asarray(moves)
+        piece_ids = move_decoding_slot[moves] + 1 + 16 * player_id
+        from_coords = np.array([self.piece_coords[piece_id] for piece_id in piece_ids]).reshape(-1, 2)
+        return piece_ids, from_coords + move_decoding_offset[moves]
+
     def encode_move(self, piece_id, coord):
-        piece_owner = piece_id_to_owner[piece_id - 1]
-        piece_coord = tuple(np.transpose(np.where(self.cur_state == piece_id))[0])
-        coord_offset = (coord[0] - piece_coord[0], coord[1] - piece_coord[1])
-        if piece_owner == 0:
-            idx_offset = piece_id_encoded_move_offset[piece_id - 1]
-        else:
-            idx_offset = piece_id_encoded_move_offset[piece_id - 16 - 1]
-        move = move_encoding_coord_offset.index(coord_offset, idx_offset)
-        return move
+        piece_coord = self.piece_coords[piece_id]
+        return int(move_encoding_table[(piece_id - 1) % 16, coord[0] - piece_coord[0] + 9, coord[1] - piece_coord[1] + 8])
         
 
 def board_state_to_player_perspective_1(board_state, player_id):
     """
     Convert the board state to the state of the player's perspective
     """
-    piece_id_to_type_ = np.array(piece_id_to_type)
-    piece_id_to_owner_ = np.array(piece_id_to_owner) == player_id
-    
-    state_copy1 = board_state.copy()
-    state_copy1[state_copy1 != 0] = piece_id_to_type_[state_copy1[np.nonzero(state_copy1)] - 1]
-
-    state_copy2 = board_state.copy()
-    state_copy2[state_copy2 != 0] = piece_id_to_owner_[state_copy2[np.nonzero(state_copy2)] - 1]
-
-    state = state_copy1 * state_copy2
-    return state
+    return player_perspective_table_1[player_id][board_state]
 
 def board_state_to_player_perspective_2(board_state, player_id):
     """
     Convert the board state to the state of the player's perspective
     """
-    piece_id_to_type_ = np.array(piece_id_to_type)
-    piece_id_to_owner_ = np.array(piece_id_to_owner)
-
-    mask = piece_id_to_owner_ == player_id
-    piece_id_to_owner_[mask] = 1
-    piece_id_to_owner_[~mask] = -1
-    
-    state_copy1 = board_state.copy()
-    state_copy1[state_copy1 != 0] = piece_id_to_type_[state_copy1[np.nonzero(state_copy1)] - 1]
-
-    state_copy2 = board_state.copy()
-    state_copy2[state_copy2 != 0] = piece_id_to_owner_[state_copy2[np.nonzero(state_copy2)] - 1]
-
-    state = state_copy1 * state_copy2
-    return state
+    return player_perspective_table_2[player_id][board_state]
 
 
@@ -1,23 +1,31 @@
 import json
+import os
 from datetime import datetime
 from PySide6.QtCore import QThread, Signal
 from game_core.board import *
 from game_core.game_info import GameMode
 from player.human_player import HumanPlayer
 from player.mcts_player import MCTSPlayer
+from player.policy_value_net import PolicyValueNet, load_cached_model
 
 
 class GameplayThread(QThread):
     player_moved_signal = Signal(int, tuple)  # piece_id, coord
     game_finished_signal = Signal(int)  # winner
+    # the bots play the first existing checkpoint (a random model if none)
+    bot_model_files = ['models/best_policy.model', 'models/current_policy.model']
+    bot_n_simulations = 400
+    bot_time_budget = 5.0  # max seconds per move of a bot playing a human
 
     def init_game(self, game_mode, start_player=0):
         if game_mode == GameMode.SELF_PLAY.value:
             self.players = [HumanPlayer(0, "gg"), HumanPlayer(1, "mm")]
         elif game_mode == GameMode.PLAY_WITH_BOT.value:
-            self.players = [HumanPlayer(0, "gg"), MCTSPlayer(1, "bot1", n_simulations=100)]
+            # the bot keeps searching on the human's time
+            self.players = [HumanPlayer(0, "gg"),
+                            self.create_bot(1, "bot1", time_budget=self.bot_time_budget, ponder=True)]
         elif game_mode == GameMode.BOT_COMBAT.value:
-            self.players = [MCTSPlayer(0, "bot1", n_simulations=100), MCTSPlayer(1, "bot2", n_simulations=100)]
+            self.players = [self.create_bot(0, "bot1"), self.create_bot(1, "bot2")]
 
         self.start_player_id = start_player
         self.cur_player_id = start_player
@@ -30,12 +38,16 @@ class GameplayThread(QThread):
             player_in_turn = self.players[self.cur_player_id]
             piece_id, coord = player_in_turn.get_action(self.board, self.cur_player_id)  # player take action
             print(f"[GameplayThread]: Player \"{player_in_turn.name}\" moved {piece_id_to_chinese_name[piece_id-1]}({piece_id}) to {coord}")
+            move = self.board.encode_move(piece_id, coord)
             self.board.move_piece(piece_id, coord)  # update board state
+            self.players[1 - self.cur_player_id].notify_move(move)  # let the opponent reuse its search tree
             self.player_moved_signal.emit(piece_id, coord)  # update UI
             game_finished, winner = self.board.game_finished()  # check game finished
             if game_finished:
                 break
             self.cur_player_id = 1 - self.cur_player_id  # switch the player
+        for player in self.players:
+            player.reset_player()  # stop pondering
         # save the replay
         cur_time = datetime.now()
         formatted_time = cur_time.strftime("%Y%m%d-%H%M")
@@ -43,6 +55,21 @@ class GameplayThread(QThread):
         # send game finished signal
         self.game_finished_signal.emit(winner)
 
+    def create_bot(self, player_id, name, time_budget=None, ponder=False):
+        """
+        Create an MCTS player with the model of the first existing checkpoint of {bot_model_files},
+        the model is loaded once and shared by the bots of all the games (see load_cached_model)
+        """
+        model_file = next((file_name for file_name in self.bot_model_files if os.path.exists(file_name)), None)
+        if model_file is None:
+            print(f"[GameplayThread]: No checkpoint in {self.bot_model_files}, the bot \"{name}\" plays a random model")
+            policy_value_net = PolicyValueNet(10, 9, 9, 192)
+        else:
+            policy_value_net = load_cached_model(model_file)
+        return MCTSPlayer(policy_value_net.policy_value_fn, player_id, name, n_simulations=self.bot_n_simulations,
+                          batch_size=8, policy_value_batch_fn=policy_value_net.policy_value_batch_fn,
+                          eval_cache_size=20000, time_budget=time_budget, ponder=ponder)
+
     def handle_user_input(self, coord):
         piece_id = self.board.cur_state[coord]
         # first input: piece
@@ -0,0 +1,43 @@
+import threading
+from collections import OrderedDict
+
+
+class EvalCache:
+    def __init__(self, max_size=100000):
+        """
+        A bounded LRU cache of network evaluations, keyed by Board.get_eval_key(), so that positions
+        reached again (e.g. through a different move order) skip the forward pass.
+        """
+        self.max_size = max_size
+        self.entries = OrderedDict()  # key -> ((actions, priors) arrays of the legal actions, score)
+        self.n_hits = 0
+        self.n_misses = 0
+        self.lock = threading.Lock()  # shared by the search threads of a tree-parallel MCTS
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                self.n_misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.n_hits += 1
+            return entry
+
+    def put(self, key, entry):
+        with self.lock:
+            self.entries[key] = entry
+            self.entries.move_to_end(key)
+            if len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)  # evict the least recently used entry
+
+    def clear(self):
+        """
+        Drop all entries, e.g. after the network params changed
+        """
+        with self.lock:
+            self.entries.clear()
+
+    def hit_rate(self):
+        n_lookups = self.n_hits + self.n_misses
+        return self.n_hits / n_lookups if n_lookups > 0 else 0.
@@ -1,3 +1,4 @@
+import time
 from typing import Optional
 from PySide6.QtCore import QThread, Signal
 
@@ -12,10 +13,17 @@ class HumanPlayer:
         
     def get_action(self, board, cur_player_id):
         while not self.action_made:
-            continue
+            time.sleep(0.01)  # leave the CPU to the other threads (e.g. a pondering bot)
         self.action_made = False
         return self.selected_piece, self.selected_coord
 
+    def notify_move(self, move):
+        # the human player follows the game on the board
+        pass
+
+    def reset_player(self):
+        pass
+
     def set_piece(self, piece_id):
         # print("HumanPlayer:handle_piece_selected()", QThread.currentThread)
         self.selected_piece = piece_id
@@ -0,0 +1,186 @@
+import queue
+import threading
+import time
+from collections import Counter, deque
+from concurrent.futures import Future
+import numpy as np
+
+
+class EvalRequest:
+    def __init__(self, state, legal_actions):
+        self.state = state
+        self.legal_actions = legal_actions
+        self.future = Future()
+        self.submit_time = time.perf_counter()
+
+
+class InferenceServer:
+    def __init__(self, policy_value_net, max_batch_size=64, timeout=0.002, n_latency_samples=10000):
+        """
+        Collect evaluation requests from many MCTS searchers (threads, or processes through InferenceClient),
+        and evaluate them in batches with a single forward pass of the policy value net.
+        max_batch_size: max num of requests evaluated together
+        timeout: max time (in seconds) to wait for more requests after the first request of a batch arrived
+        """
+        self.policy_value_net = policy_value_net
+        self.max_batch_size = max_batch_size
+        self.timeout = timeout
+        self.request_queue = queue.Queue()
+        self.batch_size_histogram = Counter()
+        self.latencies = deque(maxlen=n_latency_samples)  # seconds from submitting a request to getting its result
+        self.stop_event = threading.Event()
+        self.threads = []
+        self.remote_request_queue = None
+        self.remote_response_queues = []
+
+    def start(self):
+        self.stop_event.clear()
+        self.threads = [threading.Thread(target=self.serve, daemon=True)]
+        if self.remote_request_queue is not None:
+            self.threads.append(threading.Thread(target=self.serve_remote, daemon=True))
+        for thread in self.threads:
+            thread.start()
+
+    def stop(self):
+        self.stop_event.set()
+        for thread in self.threads:
+            thread.join()
+        self.threads = []
+
+    def submit(self, state, legal_actions):
+        """
+        Submit an eval state and its encoded legal actions (an array of indices), return a Future of
+        ((legal actions, priors) arrays, score)
+        """
+        request = EvalRequest(state, legal_actions)
+        self.request_queue.put(request)
+        return request.future
+
+    def policy_value_fn(self, board, player_id):
+        """
+        Drop-in replacement of PolicyValueNet.policy_value_fn, blocks until the batch containing the request is evaluated
+        """
+        future = self.submit(board.get_eval_state(player_id), board.get_player_encoded_moves(player_id))
+        return future.result()
+
+    def policy_value_batch_fn(self, state_batch, legal_actions_batch):
+        """
+        Drop-in replacement of PolicyValueNet.policy_value_batch_fn
+        """
+        futures = [self.submit(state, legal_actions) for state, legal_actions in zip(state_batch, legal_actions_batch)]
+        return [future.result() for future in futures]
+
+    def serve(self):
+        while not self.stop_event.is_set():
+            try:
+                batch = [self.request_queue.get(timeout=0.1)]
+            except queue.Empty:
+                continue
+            # wait a little for more requests to fill up the batch
+            deadline = time.perf_counter() + self.timeout
+            while len(batch) < self.max_batch_size:
+                remaining = deadline - time.perf_counter()
+                try:
+                    if remaining > 0:
+                        batch.append(self.request_queue.get(timeout=remaining))
+                    else:
+                        batch.append(self.request_queue.get_nowait())
+                except queue.Empty:
+                    break
+            self.evaluate(batch)
+
+    def evaluate(self, batch):
+        try:
+            results = self.policy_value_net.policy_value_batch_fn(np.array([r.state for r in batch]),
+                                                                  [r.legal_actions for r in batch])
+        except Exception as e:
+            for request in batch:
+                request.future.set_exception(e)
+            return
+        self.batch_size_histogram[len(batch)] += 1
+        done_time = time.perf_counter()
+        for request, result in zip(batch, results):
+            self.latencies.append(done_time - request.submit_time)
+            request.future.set_result(result)
+
+    ### Cross-process serving ###
+    def create_client(self, ctx):
+        """
+        Create a client which can be passed to a process created by the multiprocessing context {ctx}.
+        All clients must be created before the server starts.
+        """
+        if self.remote_request_queue is None:
+            self.remote_request_queue = ctx.Queue()
+        response_queue = ctx.Queue()
+        self.remote_response_queues.append(response_queue)
+        return InferenceClient(len(self.remote_response_queues) - 1, self.remote_request_queue, response_queue)
+
+    def serve_remote(self):
+        while not self.stop_event.is_set():
+            try:
+                client_id, request_id, state, legal_actions = self.remote_request_queue.get(timeout=0.1)
+            except queue.Empty:
+                continue
+            future = self.submit(state, legal_actions)
+            future.add_done_callback(
+                lambda f, client_id=client_id, request_id=request_id: self.send_response(client_id, request_id, f))
+
+    def send_response(self, client_id, request_id, future):
+        """
+        Send the result of a remote request to its client, or the exception raised by its evaluation
+        """
+        exception = future.exception()
+        if exception is None:
+            response = (request_id, future.result(), None)
+        else:
+            response = (request_id, None, exception)
+        self.remote_response_queues[client_id].put(response)
+
+    ### Monitoring ###
+    def get_stats(self):
+        """
+        return the queue depth, the histogram of the evaluated batch sizes and the request latency percentiles (ms)
+        """
+        latencies = np.array(self.latencies) * 1000
+        stats = {
+            'queue_depth': self.request_queue.qsize(),
+            'batch_size_histogram': dict(sorted(self.batch_size_histogram.items())),
+            'n_requests': sum(size * cnt for size, cnt in self.batch_size_histogram.items()),
+        }
+        for p in (50, 90, 99):
+            stats[f'latency_p{p}_ms'] = float(np.percentile(latencies, p)) if len(latencies) > 0 else 0.
+        return stats
+
+
+class InferenceClient:
+    def __init__(self, client_id, request_queue, response_queue):
+        """
+        A handle to an InferenceServer running in another process, created by InferenceServer.create_client()
+        """
+        self.client_id = client_id
+        self.request_queue = request_queue
+        self.response_queue = response_queue
+        self.n_requests = 0
+
+    def policy_value_fn(self, board, player_id):
+        result, = self.policy_value_batch_fn([board.get_eval_state(player_id)],
+                                             [board.get_player_encoded_moves(player_id)])
+        return result
+
+    def policy_value_batch_fn(self, state_batch, legal_actions_batch):
+        request_ids = []
+        for state, legal_actions in zip(state_batch, legal_actions_batch):
+            request_ids.append(self.n_requests)
+            self.request_queue.put((self.client_id, self.n_requests, state, legal_actions))
+            self.n_requests += 1
+        # the responses of a batch may arrive out of order
+        results = {}
+        exception = None
+        while len(results) < len(request_ids):
+            request_id, result, request_exception = self.response_queue.get()
+            results[request_id] = result
+            exception = exception or request_exception
+        if exception is not None:
+            # raised once all the responses of the batch are received, so that none is left for the next batch
+            raise exception
+        return [results[request_id] for request_id in request_ids]
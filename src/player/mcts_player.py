@@ -1,7 +1,10 @@
 import copy
 import math
+import threading
+import time
 import numpy as np
 from player.policy_value_net import PolicyValueNet
+from player.eval_cache import EvalCache
 
 
 def softmax(x):
@@ -17,6 +20,7 @@ class Node:
         self.n_visits = 0  # num of time this node was visited during MCTS. "good" are visited more often than "bad"
         self.Q = 0
         self.P = prior  # the prior probablity of selecting this state from its parent
+        self.n_virtual_loss = 0  # num of pending evaluations below this node (batched search)
         # self.player_id = player_id  # the player whose turn it is (-1 or 1)
 
     def is_leaf(self):
@@ -28,16 +32,24 @@ class Node:
         It is a combination of leaf evaluations Q, and this node's prior adjusted for its visit count, u.
         c: a number in (0, inf) controlling the relative impact of value Q, and prior probability P, on this node's score.
         """
-        u = c * self.P * math.sqrt(self.parent.n_visits) / (1 + self.n_visits)
-        return u + self.Q
+        if self.n_virtual_loss == 0 and self.parent.n_virtual_loss == 0:
+            u = c * self.P * math.sqrt(self.parent.n_visits) / (1 + self.n_visits)
+            return u + self.Q
+        # each pending evaluation counts as a lost visit, steering other selections in the batch away
+        n_visits = self.n_visits + self.n_virtual_loss
+        Q = (self.n_visits * self.Q - self.n_virtual_loss) / n_visits if n_visits > 0 else 0
+        u = c * self.P * math.sqrt(self.parent.n_visits + self.parent.n_virtual_loss) / (1 + n_visits)
+        return u + Q
     
-    def expand(self, action_probs):
+    def expand(self, action_priors):
         """
         Expand tree by creating new children.
+        action_priors: the (actions, priors) arrays of the legal actions
         """
-        for action, prob in action_probs:
-            if action not in self.children.keys():
-                self.children[action] = Node(self, prob)
+        actions, priors = action_priors
+        for action, prior in zip(actions.tolist(), priors.tolist()):
+            if action not in self.children:
+                self.children[action] = Node(self, prior)
 
     def select_child(self, c):
         """
@@ -46,6 +58,12 @@ class Node:
         """
         return max(self.children.items(), key=lambda action_node: action_node[1].ucb_score(c))
     
+    def add_virtual_loss(self, n):
+        node = self
+        while node is not None:
+            node.n_virtual_loss += n
+            node = node.parent
+
     def backpropagate(self, leaf_value):
         if self.parent:
             self.parent.backpropagate(-leaf_value)
@@ -53,89 +71,548 @@ class Node:
         self.Q = ((self.n_visits - 1) * self.Q + leaf_value) / self.n_visits
 
 
+class ThreadSafeNode(Node):
+    def __init__(self, parent, prior):
+        """
+        A Node shared by the search threads of a tree-parallel MCTS. The statistics of each node are updated under
+        its own lock, the selection reads them without locking (a slightly stale read only affects the exploration).
+        """
+        super().__init__(parent, prior)
+        self.lock = threading.Lock()
+
+    def expand(self, action_priors):
+        actions, priors = action_priors
+        with self.lock:
+            # publish the children in a single assignment, other threads may be selecting among them
+            children = dict(self.children)
+            for action, prior in zip(actions.tolist(), priors.tolist()):
+                if action not in children:
+                    children[action] = ThreadSafeNode(self, prior)
+            self.children = children
+
+    def add_virtual_loss(self, n):
+        node = self
+        while node is not None:
+            with node.lock:
+                node.n_virtual_loss += n
+            node = node.parent
+
+    def backpropagate(self, leaf_value):
+        node = self
+        while node is not None:
+            with node.lock:
+                node.n_visits += 1
+                node.Q += (leaf_value - node.Q) / node.n_visits
+            leaf_value = -leaf_value
+            node = node.parent
+
+
 class MCTS:
-    def __init__(self, policy_value_fn, c=5, n_simulations=400):
+    def __init__(self, policy_value_fn, c=5, n_simulations=400, batch_size=1, policy_value_batch_fn=None, virtual_loss=3,
+                 eval_cache_size=0, n_repetitions=2, time_budget=None, early_stop=False, n_threads=1):
         """
         policy_value_fn: a function that takes in a board state and player's id, outputs
-                         a list of (action, probability) tuples and also a score in [-1, 1]
+                         the (actions, priors) arrays of the legal actions and also a score in [-1, 1]
                          (i.e. the expected value of the end game score from the current
                          player's perspective) for the current player.
+        batch_size: num of leaves selected (using virtual loss) and evaluated together in each round
+        policy_value_batch_fn: a function that takes in a batch of eval states and their encoded legal actions
+                               (arrays of indices), outputs a list of ((actions, priors) arrays, score) for each state.
+                               Required if batch_size > 1.
+        eval_cache_size: max num of network evaluations kept in the LRU eval cache, 0: no cache
+        n_repetitions: num of occurrences of a position (in the game and the search path) which make it a terminal node,
+                       2: the first repetition is scored by the board's repetition rule instead of being searched.
+                       The root follows the game rules (n_repetitions_to_end), as the game goes on from it.
+        time_budget: max wall-clock time (in seconds) of a search, None: no limit (the search still stops after n_simulations)
+        early_stop: stop the search once the most visited root move can't be overtaken by the remaining simulations
+        n_threads: num of threads descending the shared tree concurrently (tree-parallel search, using virtual loss).
+                   Pass InferenceServer.policy_value_fn as policy_value_fn so that the leaves of all the threads are
+                   evaluated in shared batches.
         """
-        self.root = Node(None, 1.)
+        if time_budget is not None and time_budget <= 0:
+            raise ValueError(f"time_budget must be positive, got {time_budget}")
+        self.n_threads = n_threads
+        self.reset_tree()
         self.policy_value_fn = policy_value_fn
+        self.policy_value_batch_fn = policy_value_batch_fn
         self.c = c
         self.n_simulations = n_simulations
+        self.batch_size = batch_size
+        self.virtual_loss = virtual_loss
+        self.eval_cache = EvalCache(eval_cache_size) if eval_cache_size > 0 else None
+        self.n_repetitions = n_repetitions
+        self.time_budget = time_budget
+        self.early_stop = early_stop
+        self.state_batch = None
+        self.search_stats = {}  # stats of the last search, see search()
+        self.n_checked = 0  # num of simulations done at the last early stop check
     
     def get_move_probs(self, board, player_id, temp=1e-3):
+        self.search_stats = self.search(board, player_id, self.n_simulations, self.time_budget)
+        return self.get_root_probs(temp)
+
+    def search(self, board, player_id, n_simulations, time_budget=None, stop_event=None):
+        """
+        Run playouts from the root until {n_simulations} are done, the {time_budget} (seconds) is used up,
+        the best root move can't be overtaken any more (if early_stop), or the {stop_event} is set (pondering).
+        Return: a dict of the num of simulations, the time, the simulations per second and the stop reason
+        """
+        start_time = time.perf_counter()
+        if self.n_threads > 1:
+            n_done, stop_reason = self.search_parallel(board, player_id, n_simulations, time_budget, stop_event,
+                                                       start_time)
+        else:
+            n_done = 0
+            self.n_checked = 0
+            while True:
+                stop_reason = self.get_stop_reason(n_done, n_simulations, start_time, time_budget, stop_event)
+                if stop_reason is not None:
+                    break
+                if self.batch_size > 1:
+                    n_done += self.playout_batch(board, player_id, min(self.batch_size, n_simulations - n_done))
+                else:
+                    self.playout(board, player_id)
+                    n_done += 1
+        elapsed = time.perf_counter() - start_time
+        return {
+            'n_simulations': n_done,
+            'time': elapsed,
+            'simulations_per_sec': n_done / elapsed if elapsed > 0 else 0.,
+            'stop_reason': stop_reason,
+        }
+
+    def get_stop_reason(self, n_done, n_simulations, start_time, time_budget, stop_event):
+        """
+        Return: the reason to stop a search which has done {n_done} simulations, None: go on
+        """
+        elapsed = time.perf_counter() - start_time
+        if n_done >= n_simulations:
+            return "n_simulations"
+        if n_done == 0 and self.is_leaf(self.root):
+            return None  # expand a fresh root whatever the time left, a move needs root visits
+        if time_budget is not None and elapsed >= time_budget:
+            return "time_budget"
+        if stop_event is not None and stop_event.is_set():
+            return "stopped"
+        if self.early_stop and n_done - self.n_checked >= 8:
+            self.n_checked = n_done
+            n_remaining = n_simulations - n_done
+            if time_budget is not None:
+                n_remaining = min(n_remaining, n_done / elapsed * (time_budget - elapsed))
+            if self.check_early_stop(n_remaining):
+                return "early_stop"
+        return None
+
+    def search_parallel(self, board, player_id, n_simulations, time_budget, stop_event, start_time):
+        """
+        Tree-parallel search: {n_threads} threads, each on its own copy of the board, run playouts on the shared tree
+        Return: num of simulations done, the stop reason
+        """
+        n_done = 0
+        if self.is_leaf(self.root) and n_simulations > 0:
+            # expand the root first, or all the threads would evaluate it at once
+            self.playout(board, player_id)
+            n_done = 1
+        self.n_checked = n_done
+        counter_lock = threading.Lock()
+        counter = {'n_started': n_done, 'stop_reason': None}
+
+        def worker(worker_board):
+            while True:
+                with counter_lock:
+                    if counter['stop_reason'] is None:
+                        counter['stop_reason'] = self.get_stop_reason(counter['n_started'], n_simulations, start_time,
+                                                                      time_budget, stop_event)
+                    if counter['stop_reason'] is not None:
+                        return
+                    counter['n_started'] += 1
+                self.playout_parallel(worker_board, player_id)
+
+        threads = [threading.Thread(target=worker, args=(copy.deepcopy(board),), daemon=True)
+                   for _ in range(self.n_threads)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return counter['n_started'], counter['stop_reason'] or "n_simulations"
+
+    def playout_parallel(self, board, player_id):
+        """
+        A playout run by one of the threads of a tree-parallel search, the virtual loss on the path
+        steers the other threads to other leaves while the leaf is being evaluated
+        """
+        node = self.root
+        n_moves = 0
+        while not node.is_leaf():
+            action, node = node.select_child(self.c)
+            piece_id, coord = board.decode_move(action, board.cur_player)
+            board.make_move(piece_id, coord)
+            n_moves += 1
+
+        finished, winner = board.game_finished(self.n_repetitions if n_moves > 0 else None)
+        if finished:
+            leaf_value = self.get_terminal_value(winner, board.cur_player)
+        else:
+            node.add_virtual_loss(self.virtual_loss)
+            action_priors, leaf_value = self.evaluate(board)
+            node.expand(action_priors)
+            node.add_virtual_loss(-self.virtual_loss)
+        node.backpropagate(-leaf_value)
+
+        # rewind the board to the root position
+        for _ in range(n_moves):
+            board.unmake_move()
+
+    def check_early_stop(self, n_remaining):
+        """
+        Check if the most visited root move stays the most visited whatever the {n_remaining} simulations do
+        """
+        if self.is_leaf(self.root):
+            return False
+        acts, visits = self.get_root_visits()
+        if len(visits) == 1:
+            return True
+        second, best = np.partition(np.asarray(visits), -2)[-2:]
+        return best - second > n_remaining
+
+    def playout(self, board, player_id):
+        # select the first leaf node, making the moves on the board in place
         node = self.root
-        # # expand the root node
-        # action_probs, leaf_value = self.policy_value_fn(board, player_id)
-        # node.expand(action_probs)
+        n_moves = 0
+        while not self.is_leaf(node):
+            action, node = self.select_child(node)
+            piece_id, coord = board.decode_move(action, board.cur_player)
+            board.make_move(piece_id, coord)
+            n_moves += 1
+
+        # check game finished, terminal nodes need no evaluation
+        finished, winner = board.game_finished(self.n_repetitions if n_moves > 0 else None)
+        if finished:
+            leaf_value = self.get_terminal_value(winner, board.cur_player)
+        else:
+            # Evaluate the leaf using a network which outputs the (actions, priors) p of the legal actions
+            # and also a score v in [-1, 1] for the current player, then expand the leaf node
+            action_priors, leaf_value = self.evaluate(board)
+            self.expand(node, action_priors)
+
+        # update value and visit count of nodes in this traversal
+        self.backpropagate(node, -leaf_value)
 
-        # perform playouts {n_simulations} times
-        for i in range(self.n_simulations):
-            board_copy = copy.deepcopy(board)
+        # rewind the board to the root position
+        for _ in range(n_moves):
+            board.unmake_move()
 
-            # select the first leaf node
+    def playout_batch(self, board, player_id, n_leaves):
+        """
+        Select up to {n_leaves} leaves, applying virtual loss along each path so that the following
+        selections diverge, evaluate them with a single call of policy_value_batch_fn, then expand
+        and back them all up.
+        Return: num of playouts performed
+        """
+        pending = []  # (leaf node, encoded legal actions, eval cache key)
+        pending_nodes = set()
+        if self.state_batch is None or len(self.state_batch) < n_leaves:
+            # the eval states of the pending leaves are gathered into a preallocated batch
+            self.state_batch = np.empty((n_leaves, len(board.eval_state_indices[0, 0, 0])) + board.eval_planes.shape[1:],
+                                        dtype=board.eval_planes.dtype)
+        n_playouts = 0
+        for i in range(n_leaves):
             node = self.root
-            while not node.is_leaf():
-                action, node = node.select_child(self.c)
-                piece_id, coord = board_copy.decode_move(action, board_copy.cur_player)
-                board_copy.move_piece(piece_id, coord)
-        
-            # Evaluate the leaf using a network which outputs a list of action, probability) tuples p 
-            # and also a score v in [-1, 1] for the current player.
-            action_probs, leaf_value = self.policy_value_fn(board_copy, board_copy.cur_player)
-            # check game finished
-            finished, winner = board_copy.game_finished()
-            if not finished:
-                # expand the leaf node
-                node.expand(action_probs)
+            n_moves = 0
+            while not self.is_leaf(node):
+                action, node = self.select_child(node)
+                piece_id, coord = board.decode_move(action, board.cur_player)
+                board.make_move(piece_id, coord)
+                n_moves += 1
+
+            if node in pending_nodes:
+                # the virtual loss failed to steer the selection to a new leaf, evaluate what we have
+                leaf_collision = True
             else:
-                if winner == -1:
-                    leaf_value = 0.
+                leaf_collision = False
+                finished, winner = board.game_finished(self.n_repetitions if n_moves > 0 else None)
+                key = None
+                if not finished and self.eval_cache is not None:
+                    key = board.get_eval_key(board.cur_player)
+                    entry = self.eval_cache.get(key)
+                if finished:
+                    # terminal nodes need no evaluation, back them up right away
+                    self.backpropagate(node, -self.get_terminal_value(winner, board.cur_player))
+                elif key is not None and entry is not None:
+                    # so do the positions evaluated before
+                    action_priors, leaf_value = entry
+                    self.expand(node, action_priors)
+                    self.backpropagate(node, -leaf_value)
                 else:
-                    leaf_value = 1. if winner == player_id else -1.
+                    self.add_virtual_loss(node, self.virtual_loss)
+                    board.get_eval_state(board.cur_player, out=self.state_batch[len(pending)])
+                    pending.append((node, board.get_player_encoded_moves(board.cur_player), key))
+                    pending_nodes.add(node)
+                n_playouts += 1
+
+            # rewind the board to the root position
+            for _ in range(n_moves):
+                board.unmake_move()
+            if leaf_collision:
+                break
+
+        if pending:
+            leaves, legal_actions_batch, keys = zip(*pending)
+            results = self.policy_value_batch_fn(self.state_batch[:len(pending)], legal_actions_batch)
+            for node, key, (action_priors, leaf_value) in zip(leaves, keys, results):
+                if key is not None:
+                    self.eval_cache.put(key, (action_priors, leaf_value))
+                self.add_virtual_loss(node, -self.virtual_loss)
+                self.expand(node, action_priors)
+                self.backpropagate(node, -leaf_value)
+        return n_playouts
 
-            # update value and visit count of nodes in this traversal
-            node.backpropagate(-leaf_value)
+    def evaluate(self, board):
+        """
+        Evaluate the board for the current player, through the eval cache if enabled
+        """
+        if self.eval_cache is None:
+            return self.policy_value_fn(board, board.cur_player)
+        key = board.get_eval_key(board.cur_player)
+        entry = self.eval_cache.get(key)
+        if entry is None:
+            action_priors, leaf_value = self.policy_value_fn(board, board.cur_player)
+            entry = (action_priors, float(leaf_value))
+            self.eval_cache.put(key, entry)
+        return entry
+
+    def get_terminal_value(self, winner, player_id):
+        """
+        Return the end game score from the perspective of {player_id} (the player to move in the terminal position)
+        """
+        if winner == -1:
+            return 0.
+        return 1. if winner == player_id else -1.
 
+    def get_root_probs(self, temp):
         # calc the move probabilities based on visit counts at the root node
-        act_visits = [(act, node_.n_visits) for act, node_ in self.root.children.items()]
-        acts, visits = zip(*act_visits)
+        acts, visits = self.get_root_visits()
         act_probs = softmax(1.0/temp * np.log(np.array(visits) + 1e-10))
         return acts, act_probs
-    
+
+    ### Tree primitives, overridden by ArrayMCTS ###
+    def reset_tree(self):
+        self.root = ThreadSafeNode(None, 1.) if self.n_threads > 1 else Node(None, 1.)
+
+    def is_leaf(self, node):
+        return node.is_leaf()
+
+    def select_child(self, node):
+        """
+        Return: A tuple of (action, child node) with the maximum UCB score
+        """
+        return node.select_child(self.c)
+
+    def expand(self, node, action_priors):
+        node.expand(action_priors)
+
+    def backpropagate(self, node, leaf_value):
+        node.backpropagate(leaf_value)
+
+    def add_virtual_loss(self, node, n):
+        node.add_virtual_loss(n)
+
+    def get_root_visits(self):
+        """
+        Return: A tuple of (actions, visit counts) of the children of the root node
+        """
+        act_visits = [(act, node_.n_visits) for act, node_ in self.root.children.items()]
+        acts, visits = zip(*act_visits)
+        return acts, visits
+
     def update_with_move(self, last_move):
         """
         Step forward in the tree, keeping everything we already know about the subtree.
+        Return: num of visits retained in the new root
         """
         if last_move in self.root.children.keys():
             # make the child node of the select move the new root
             self.root = self.root.children[last_move]
             self.root.parent = None
+            return self.root.n_visits
         else:
             # reset the tree
-            self.root = Node(None, 1.)
+            self.reset_tree()
+            return 0
+
+
+class ArrayMCTS(MCTS):
+    def __init__(self, *args, capacity=1 << 16, **kwargs):
+        """
+        MCTS storing the tree in preallocated numpy arrays indexed by node id instead of Node objects.
+        The children of a node occupy a contiguous range of ids, so the PUCT selection is vectorized over the range.
+        Takes the same arguments as MCTS, plus the initial capacity (num of nodes) of the arrays.
+        """
+        self.capacity = capacity
+        if kwargs.get('n_threads', 1) > 1:
+            raise ValueError("the tree-parallel search needs the node engine")
+        super().__init__(*args, **kwargs)
+
+    def reset_tree(self):
+        self.N = np.zeros(self.capacity, dtype=np.int32)  # visit counts
+        self.W = np.zeros(self.capacity)  # total values, Q = W / N
+        self.P = np.zeros(self.capacity)  # prior probabilities
+        self.VL = np.zeros(self.capacity, dtype=np.int32)  # virtual losses
+        self.action = np.zeros(self.capacity, dtype=np.int32)  # the action leading to the node from its parent
+        self.parent = np.full(self.capacity, -1, dtype=np.int32)
+        self.first_child = np.full(self.capacity, -1, dtype=np.int32)  # -1: not expanded
+        self.n_children = np.zeros(self.capacity, dtype=np.int32)
+        self.P[0] = 1.
+        self.root = 0
+        self.size = 1  # num of node ids in use
+
+    def ensure_capacity(self, n_nodes):
+        if n_nodes <= self.capacity:
+            return
+        self.capacity = max(self.capacity * 2, n_nodes)
+        for name in ('N', 'W', 'P', 'VL', 'action', 'parent', 'first_child', 'n_children'):
+            arr = getattr(self, name)
+            new_arr = np.empty(self.capacity, dtype=arr.dtype)
+            new_arr[:self.size] = arr[:self.size]
+            setattr(self, name, new_arr)
+
+    def is_leaf(self, node):
+        return self.first_child[node] < 0
+
+    def select_child(self, node):
+        first = self.first_child[node]
+        children = slice(first, first + self.n_children[node])
+        n_visits = self.N[children] + self.VL[children]
+        # each pending evaluation counts as a lost visit
+        Q = (self.W[children] - self.VL[children]) / np.maximum(n_visits, 1)
+        u = self.c * self.P[children] * math.sqrt(self.N[node] + self.VL[node]) / (1 + n_visits)
+        child = first + int(np.argmax(Q + u))
+        return int(self.action[child]), child
+
+    def expand(self, node, action_priors):
+        if self.first_child[node] >= 0:
+            return
+        actions, priors = action_priors
+        n = len(actions)
+        if n == 0:
+            return
+        self.ensure_capacity(self.size + n)
+        children = slice(self.size, self.size + n)
+        self.action[children] = actions
+        self.P[children] = priors
+        self.N[children] = 0
+        self.W[children] = 0
+        self.VL[children] = 0
+        self.parent[children] = node
+        self.first_child[children] = -1
+        self.n_children[children] = 0
+        self.first_child[node] = self.size
+        self.n_children[node] = n
+        self.size += n
+
+    def backpropagate(self, node, leaf_value):
+        while node >= 0:
+            self.N[node] += 1
+            self.W[node] += leaf_value
+            leaf_value = -leaf_value
+            node = self.parent[node]
+
+    def add_virtual_loss(self, node, n):
+        while node >= 0:
+            self.VL[node] += n
+            node = self.parent[node]
+
+    def get_root_visits(self):
+        first = self.first_child[self.root]
+        children = slice(first, first + self.n_children[self.root])
+        return tuple(self.action[children].tolist()), self.N[children]
+
+    def update_with_move(self, last_move):
+        """
+        Step forward in the tree, keeping everything we already know about the subtree.
+        Return: num of visits retained in the new root
+        """
+        first = self.first_child[self.root]
+        if first >= 0:
+            match = np.nonzero(self.action[first:first + self.n_children[self.root]] == last_move)[0]
+            if len(match) > 0:
+                self.compact(first + match[0])
+                return int(self.N[self.root])
+        # reset the tree
+        self.reset_tree()
+        return 0
+
+    def compact(self, new_root):
+        """
+        Move the subtree of {new_root} to the front of the arrays (in breadth-first order, which keeps
+        the children of each node contiguous), dropping the rest of the tree.
+        """
+        levels = [np.array([new_root])]
+        while True:
+            expanded = levels[-1][self.first_child[levels[-1]] >= 0]
+            if len(expanded) == 0:
+                break
+            counts = self.n_children[expanded]
+            offsets = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+            levels.append(np.repeat(self.first_child[expanded], counts) + offsets)
+        old_ids = np.concatenate(levels)
+        new_ids = np.full(self.size, -1, dtype=np.int32)
+        new_ids[old_ids] = np.arange(len(old_ids))
+        n = len(old_ids)
+        for name in ('N', 'W', 'P', 'VL', 'action', 'n_children'):
+            arr = getattr(self, name)
+            arr[:n] = arr[old_ids]
+        first_child = self.first_child[old_ids]
+        self.first_child[:n] = np.where(first_child >= 0, new_ids[first_child], -1)
+        self.parent[:n] = new_ids[self.parent[old_ids]]
+        self.parent[0] = -1
+        self.root = 0
+        self.size = n
 
 
 class MCTSPlayer:
-    def __init__(self, policy_value_fn, player_id, name, c=5, n_simulations=400, is_training=False):
+    def __init__(self, policy_value_fn, player_id, name, c=5, n_simulations=400, is_training=False,
+                 batch_size=1, policy_value_batch_fn=None, eval_cache_size=0, engine="node",
+                 time_budget=None, early_stop=False, ponder=False, n_ponder_simulations=10000, n_threads=1):
+        """
+        engine: the tree representation, "node" (Node objects) or "array" (numpy arrays, see ArrayMCTS)
+        time_budget: max seconds per move, early_stop, n_threads: see MCTS
+        ponder: keep searching the tree on the opponent's time, until the opponent's move is notified
+                (at most {n_ponder_simulations} simulations)
+        """
         self.player_id = player_id
         self.name = name
-        self.mcts = MCTS(policy_value_fn, c, n_simulations)
+        mcts_class = ArrayMCTS if engine == "array" else MCTS
+        self.mcts = mcts_class(policy_value_fn, c, n_simulations, batch_size, policy_value_batch_fn,
+                               eval_cache_size=eval_cache_size, time_budget=time_budget, early_stop=early_stop,
+                               n_threads=n_threads)
         self.is_training = is_training
+        self.ponder = ponder
+        self.n_ponder_simulations = n_ponder_simulations
+        self.ponder_thread = None
+        self.ponder_stop_event = threading.Event()
+        self.search_stats = {}  # stats of the last search
+        self.ponder_stats = {}  # stats of the last pondering
+        self.tree_ply = None  # the ply (num of moves made on the board) of the root of the search tree, None: fresh tree
+        self.n_retained_visits = 0  # num of visits kept in the tree by the last tree update
 
     def get_action(self, board, player_id, temp=1e-3, return_probs=False):
+        self.stop_pondering()
+        if self.tree_ply is not None and self.tree_ply != len(board.all_moves):
+            # a move was not notified, the tree doesn't match the board any more
+            self.reset_player()
         acts, act_probs = self.mcts.get_move_probs(board, player_id, temp)
+        self.search_stats = self.mcts.search_stats
         if self.is_training:
             move = np.random.choice(acts, p=0.75*act_probs+0.25*np.random.dirichlet(0.3*np.ones(len(act_probs))))
-            self.mcts.update_with_move(move)
-            # self.mcts.update_with_move(-1)
         else:
             move = np.random.choice(acts, p=act_probs)
-            self.mcts.update_with_move(-1)
         decoded_move = board.decode_move(move, player_id)
+        # keep the subtree of the move, to be advanced again by the opponent's move (see notify_move)
+        self.n_retained_visits = self.mcts.update_with_move(move)
+        self.tree_ply = len(board.all_moves) + 1
+        if self.ponder:
+            self.start_pondering(board, decoded_move)
 
         if return_probs:
             move_probs = np.zeros(192)  # n_actions
@@ -144,5 +621,47 @@ class MCTSPlayer:
         else:
             return decoded_move
         
+    def notify_move(self, move):
+        """
+        Advance the search tree with the encoded move the opponent made, so that the next search starts
+        from the subtree already explored below it.
+        Return: num of visits retained in the tree
+        """
+        self.stop_pondering()
+        self.n_retained_visits = self.mcts.update_with_move(move)
+        if self.tree_ply is not None:
+            self.tree_ply += 1
+        return self.n_retained_visits
+
     def reset_player(self):
-        self.mcts.update_with_move(-1)
\ No newline at end of file
+        self.stop_pondering()
+        self.mcts.update_with_move(-1)
+        self.tree_ply = None
+
+    def start_pondering(self, board, move):
+        """
+        Search the position after {move} (the tree root) in a background thread, on a copy of the board
+        since the game keeps using the board meanwhile
+        """
+        ponder_board = copy.deepcopy(board)
+        ponder_board.move_piece(*move)
+        self.ponder_stop_event.clear()
+
+        def ponder():
+            self.ponder_stats = self.mcts.search(ponder_board, ponder_board.cur_player, self.n_ponder_simulations,
+                                                 stop_event=self.ponder_stop_event)
+        self.ponder_thread = threading.Thread(target=ponder, daemon=True)
+        self.ponder_thread.start()
+
+    def stop_pondering(self):
+        if self.ponder_thread is not None:
+            self.ponder_stop_event.set()
+            self.ponder_thread.join()
+            self.ponder_thread = None
+
+    def clear_eval_cache(self):
+        """
+        Drop the cached network evaluations, must be called after the network params changed
+        """
+        if self.mcts.eval_cache is not None:
+            self.mcts.eval_cache.clear()
\ No newline at end of file
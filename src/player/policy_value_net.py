@@ -1,9 +1,12 @@
+import copy
+import math
+import os
+import threading
 import numpy as np
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
 import torch.optim as optim
-from torch.autograd import Variable
 
 
 class ChessNet(nn.Module):
@@ -52,50 +55,271 @@ class ChessNet(nn.Module):
         return x_policy, x_value
 
 
+class SqueezeExcitation(nn.Module):
+    def __init__(self, n_filters, ratio=4):
+        """
+        Rescale the channels by weights computed from their global average
+        """
+        super().__init__()
+        self.fc1 = nn.Linear(n_filters, n_filters // ratio)
+        self.fc2 = nn.Linear(n_filters // ratio, n_filters)
+
+    def forward(self, x):
+        scale = torch.sigmoid(self.fc2(F.relu(self.fc1(x.mean(dim=(2, 3))))))
+        return x * scale[:, :, None, None]
+
+
+class ResidualBlock(nn.Module):
+    def __init__(self, n_filters, se=False):
+        super().__init__()
+        self.conv1 = nn.Conv2d(n_filters, n_filters, kernel_size=3, padding=1, bias=False)
+        self.bn1 = nn.BatchNorm2d(n_filters)
+        self.conv2 = nn.Conv2d(n_filters, n_filters, kernel_size=3, padding=1, bias=False)
+        self.bn2 = nn.BatchNorm2d(n_filters)
+        self.se = SqueezeExcitation(n_filters) if se else None
+
+    def forward(self, x):
+        out = F.relu(self.bn1(self.conv1(x)))
+        out = self.bn2(self.conv2(out))
+        if self.se is not None:
+            out = self.se(out)
+        return F.relu(out + x)
+
+
+class ResNet(nn.Module):
+    def __init__(self, height, width, channel, n_actions, n_blocks=6, n_filters=64, se=False):
+        """
+        A tower of {n_blocks} residual blocks of {n_filters} filters (with squeeze-excitation if {se}),
+        followed by the same policy and value heads as ChessNet
+        """
+        super().__init__()
+        self.board_height = height
+        self.board_width = width
+        self.channel = channel
+
+        # common layers
+        self.conv_input = nn.Conv2d(channel, n_filters, kernel_size=3, padding=1, bias=False)
+        self.bn_input = nn.BatchNorm2d(n_filters)
+        self.blocks = nn.Sequential(*[ResidualBlock(n_filters, se) for _ in range(n_blocks)])
+
+        # policy net
+        self.policy_conv = nn.Conv2d(n_filters, 4, kernel_size=1, bias=False)
+        self.policy_bn = nn.BatchNorm2d(4)
+        self.policy_fc = nn.Linear(4 * height * width, n_actions)
+
+        # value net
+        self.value_conv = nn.Conv2d(n_filters, 2, kernel_size=1, bias=False)
+        self.value_bn = nn.BatchNorm2d(2)
+        self.value_fc1 = nn.Linear(2 * height * width, 64)
+        self.value_fc2 = nn.Linear(64, 1)
+
+    def forward(self, input):
+        # common layers
+        x = self.blocks(F.relu(self.bn_input(self.conv_input(input))))
+
+        # policy net
+        x_policy = F.relu(self.policy_bn(self.policy_conv(x)))
+        x_policy = F.log_softmax(self.policy_fc(x_policy.flatten(1)), dim=1)
+
+        # value net
+        x_value = F.relu(self.value_bn(self.value_conv(x)))
+        x_value = F.relu(self.value_fc1(x_value.flatten(1)))
+        x_value = torch.tanh(self.value_fc2(x_value))
+
+        return x_policy, x_value
+
+
+# the architectures selectable by the "arch" of a model config, the other entries of the config are passed to the class
+MODEL_REGISTRY = {
+    "chessnet": ChessNet,
+    "resnet": ResNet,
+}
+
+INFERENCE_DTYPES = ("float32", "bfloat16", "int8")
+CHECKPOINT_VERSION = 1
+INPUT_ENCODING_VERSION = 1  # to be bumped whenever the eval state planes or the move encoding change
+
+
+def build_model(model_config, height, width, channel, n_actions):
+    """
+    Build the model described by {model_config}, e.g. {"arch": "resnet", "n_blocks": 6, "n_filters": 64, "se": True}
+    """
+    model_config = dict(model_config)
+    arch = model_config.pop("arch")
+    if arch not in MODEL_REGISTRY:
+        raise ValueError(f"unknown model architecture {arch}, expected one of {list(MODEL_REGISTRY)}")
+    return MODEL_REGISTRY[arch](height, width, channel, n_actions, **model_config)
+
+
+model_cache = {}  # (checkpoint path, inference options) -> (modification time, PolicyValueNet), see load_cached_model()
+model_cache_lock = threading.Lock()
+
+
+def load_checkpoint(file_name, map_location=None):
+    """
+    Load a checkpoint saved by PolicyValueNet.save_model, return its dict (see PolicyValueNet.get_checkpoint).
+    The bare state_dicts saved before the checkpoints had metadata are loaded as ChessNet checkpoints.
+    """
+    checkpoint = torch.load(file_name, map_location=map_location)
+    if "checkpoint_version" not in checkpoint:
+        checkpoint = {
+            "checkpoint_version": 0,
+            "model_config": {"arch": "chessnet"},
+            "board_height": 10,
+            "board_width": 9,
+            "n_state_channels": checkpoint["conv1.weight"].shape[1],
+            "n_actions": checkpoint["policy_fc1.weight"].shape[0],
+            "input_encoding_version": INPUT_ENCODING_VERSION,
+            "train_step": 0,
+            "state_dict": checkpoint,
+        }
+    return checkpoint
+
+
 class PolicyValueNet():
-    def __init__(self, board_height, board_width, n_state_channels, n_actions):
+    def __init__(self, board_height, board_width, n_state_channels, n_actions, inference_dtype="float32", jit=False,
+                 model_config=None):
+        """
+        model_config: the architecture of the model, see build_model(), None: ChessNet
+        The searches evaluate the positions with a frozen copy of the model (rebuilt after the params change):
+        inference_dtype: "float32", "bfloat16", or "int8" (dynamic quantization of the linear layers, cpu only)
+        jit: compile the copy with torch.jit.trace
+        """
+        if inference_dtype not in INFERENCE_DTYPES:
+            raise ValueError(f"unknown inference dtype {inference_dtype}, expected one of {INFERENCE_DTYPES}")
         self.board_height = board_height
         self.board_width = board_width
         self.n_state_channels = n_state_channels
         self.n_actions = n_actions
         self.device = torch.device("cuda") if torch.cuda.is_available() else torch.device("cpu")
-        self.model = ChessNet(board_height, board_width, n_state_channels, n_actions).to(self.device)
+        if inference_dtype == "int8" and self.device.type != "cpu":
+            raise ValueError("int8 inference is only supported on cpu")
+        self.inference_dtype = inference_dtype
+        self.jit = jit
+        self.model_config = dict(model_config or {"arch": "chessnet"})
+        # the model stays in eval mode (batch norm using its running statistics) outside of train_step()
+        self.model = build_model(self.model_config, board_height, board_width, n_state_channels, n_actions)
+        self.model = self.model.to(self.device).eval()
+        self.n_train_steps = 0
         self.optimizer = optim.Adam(self.model.parameters(), weight_decay=1e-4)
+        self.inference_model = None  # built by get_inference_model()
+        self.thread_local = threading.local()  # the input buffers of each thread, see get_input_buffer()
+
+    def get_inference_model(self):
+        """
+        Return the model used by the searches, built from the current params if needed
+        """
+        if self.inference_model is not None:
+            return self.inference_model
+        if self.inference_dtype == "float32" and not self.jit:
+            self.inference_model = self.model
+            return self.model
+        model = copy.deepcopy(self.model).eval()
+        if self.inference_dtype == "bfloat16":
+            model = model.to(torch.bfloat16)
+        elif self.inference_dtype == "int8":
+            model = torch.ao.quantization.quantize_dynamic(model, {nn.Linear}, dtype=torch.qint8)
+        if self.jit:
+            example = torch.zeros(1, self.n_state_channels, self.board_height, self.board_width, device=self.device,
+                                  dtype=torch.bfloat16 if self.inference_dtype == "bfloat16" else torch.float32)
+            with torch.no_grad():
+                model = torch.jit.freeze(torch.jit.trace(model, example))
+        self.inference_model = model
+        return model
+
+    def get_input_buffer(self, batch_size, state_shape):
+        """
+        Return a preallocated input tensor of {batch_size} states (pinned if the model runs on a GPU),
+        one per thread as the searches may evaluate positions from several threads
+        """
+        buffer = getattr(self.thread_local, 'input_buffer', None)
+        if buffer is None or len(buffer) < batch_size or buffer.shape[1:] != state_shape:
+            buffer = torch.empty((batch_size,) + tuple(state_shape), dtype=torch.float32,
+                                 pin_memory=self.device.type == "cuda")
+            self.thread_local.input_buffer = buffer
+        return buffer[:batch_size]
+
+    def to_input_tensor(self, state_batch):
+        """
+        Wrap a float32 numpy batch of states as an input tensor on the device:
+        without a copy on cpu, through the pinned input buffer on a GPU
+        """
+        tensor = torch.from_numpy(np.ascontiguousarray(state_batch, dtype=np.float32))
+        if self.device.type == "cpu":
+            return tensor
+        buffer = self.get_input_buffer(len(tensor), tensor.shape[1:])
+        buffer.copy_(tensor)
+        return buffer.to(self.device, non_blocking=True)
+
+    def forward(self, state_batch, inference=False):
+        """
+        input: an input tensor of states, inference: evaluate them with the inference model instead of the trained model
+        output: float32 tensors of the log action probabilities and the state values
+        """
+        model = self.get_inference_model() if inference else self.model
+        if model is not self.model and self.inference_dtype == "bfloat16":
+            state_batch = state_batch.to(torch.bfloat16)
+        with torch.inference_mode():
+            log_act_probs, value = model(state_batch)
+            if model is not self.model and self.inference_dtype == "bfloat16":
+                # renormalize, the bfloat16 probs don't sum to 1
+                log_act_probs = F.log_softmax(log_act_probs.float(), dim=1)
+            return log_act_probs.float(), value.float()
+
+    def legal_policy_value(self, state_batch, legal_actions_batch):
+        """
+        input: an input tensor of states, and the encoded legal actions (an array of indices) of each state
+        output: a list of (legal actions, priors) arrays for each state, and the state values as a numpy array.
+        The softmax over the legal actions of the whole batch is a single masked tensor op.
+        """
+        log_act_probs, value = self.forward(state_batch, inference=True)
+        lengths = [len(legal_actions) for legal_actions in legal_actions_batch]
+        actions = np.concatenate(legal_actions_batch).astype(np.int64)
+        rows = torch.from_numpy(np.repeat(np.arange(len(lengths)), lengths)).to(self.device)
+        columns = torch.from_numpy(actions).to(self.device)
+        with torch.inference_mode():
+            mask = torch.full_like(log_act_probs, -math.inf)
+            mask[rows, columns] = 0
+            priors = torch.softmax(log_act_probs + mask, dim=1)[rows, columns].cpu().numpy()
+        splits = np.cumsum(lengths)[:-1]
+        return list(zip(np.split(actions, splits), np.split(priors, splits))), value.cpu().numpy()[:, 0]
 
     def policy_value_fn(self, board, player_id):
         """
         input: board, player_id
-        output: a list of (action, probability) tuples for each available action and the score of the board state
-        """
-        # evaluate the current state of the board
-        eval_state = board.get_eval_state(player_id)
-        eval_state = np.ascontiguousarray(eval_state.reshape(-1, self.n_state_channels, self.board_height, self.board_width))
-        log_act_probs, value = self.model(Variable(torch.from_numpy(eval_state)).to(self.device).float())
-        act_probs = np.exp(log_act_probs.data.cpu().numpy().flatten())
-        # filter out the unavailable actions, normalize the new act_probs
-        legal_moves = board.get_player_encoded_availables(player_id)
-        act_probs[np.array(legal_moves) == 0] = 0.
-        act_probs = act_probs[act_probs != 0.]
-        act_probs /= np.sum(act_probs)
-        act_probs = zip(np.nonzero(legal_moves)[0], act_probs)
-        return act_probs, value.data[0][0]
+        output: the (legal actions, priors) arrays and the score of the board state
+        """
+        # gather the eval state of the board right into the input buffer
+        input_buffer = self.get_input_buffer(1, (self.n_state_channels, board.height, board.width))
+        board.get_eval_state(player_id, out=input_buffer.numpy()[0])
+        (action_priors,), value = self.legal_policy_value(input_buffer.to(self.device, non_blocking=True),
+                                                          [board.get_player_encoded_moves(player_id)])
+        return action_priors, float(value[0])
     
-    def policy_value(self, state_batch):
+    def policy_value_batch_fn(self, state_batch, legal_actions_batch):
         """
-        input: a batch of states
-        output: a batch of action probabilities and state values
+        input: a batch of eval states, and the encoded legal actions (an array of indices) of each state
+        output: a list of ((legal actions, priors) arrays, score) for each state
         """
-        state_batch = Variable(torch.FloatTensor(state_batch).to(self.device))
-        log_act_probs, value = self.model(state_batch)
-        act_probs = np.exp(log_act_probs.data.cpu().numpy())
-        return act_probs, value.data.cpu().numpy()
+        action_priors_batch, value_batch = self.legal_policy_value(self.to_input_tensor(state_batch),
+                                                                   legal_actions_batch)
+        return list(zip(action_priors_batch, value_batch.tolist()))
+
+    def policy_value(self, state_batch, inference=False):
+        """
+        input: a float32 numpy batch of states, inference: see forward()
+        output: numpy arrays of the action probabilities and the state values
+        """
+        log_act_probs, value = self.forward(self.to_input_tensor(state_batch), inference)
+        return np.exp(log_act_probs.cpu().numpy()), value.cpu().numpy()
 
     def train_step(self, state_batch, mcts_probs, winner_batch, lr):
         # wrap data
-        state_batch = Variable(torch.FloatTensor(state_batch).to(self.device))
-        mcts_probs = Variable(torch.FloatTensor(mcts_probs).to(self.device))
-        winner_batch = Variable(torch.FloatTensor(winner_batch).to(self.device))
+        state_batch = self.to_input_tensor(state_batch)
+        mcts_probs = torch.from_numpy(np.asarray(mcts_probs, dtype=np.float32)).to(self.device)
+        winner_batch = torch.from_numpy(np.asarray(winner_batch, dtype=np.float32)).to(self.device)
 
+        self.model.train()
         # zero the parameter gradients
         self.optimizer.zero_grad()
         # set learning rate
@@ -112,9 +336,80 @@ class PolicyValueNet():
         # backward and optimize
         loss.backward()
         self.optimizer.step()
+        self.model.eval()
+        self.inference_model = None
+        self.n_train_steps += 1
         # calc policy entropy, for monitoring only
         entropy = -torch.mean(torch.sum(torch.exp(log_act_probs) * log_act_probs, 1))
         return loss.item(), entropy.item()
     
+    def get_policy_param(self):
+        """
+        return a snapshot of the model params as a state_dict on cpu (e.g. to be sent to another process)
+        """
+        return {k: v.detach().cpu().clone() for k, v in self.model.state_dict().items()}
+
+    def load_policy_param(self, policy_param):
+        self.model.load_state_dict(policy_param)
+        self.inference_model = None
+
+    def get_checkpoint(self):
+        """
+        return the model params with the metadata needed to rebuild the model
+        """
+        return {
+            "checkpoint_version": CHECKPOINT_VERSION,
+            "model_config": self.model_config,
+            "board_height": self.board_height,
+            "board_width": self.board_width,
+            "n_state_channels": self.n_state_channels,
+            "n_actions": self.n_actions,
+            "input_encoding_version": INPUT_ENCODING_VERSION,
+            "train_step": self.n_train_steps,
+            "state_dict": self.model.state_dict(),
+        }
+
     def save_model(self, file_name):
-        torch.save(self.model.state_dict(), file_name)
\ No newline at end of file
+        torch.save(self.get_checkpoint(), file_name)
+
+    def load_model(self, file_name):
+        """
+        load the params of a checkpoint, which must have been saved by a model of the same architecture and inputs
+        (see from_checkpoint() to rebuild the model of any checkpoint)
+        """
+        self.load_checkpoint_params(load_checkpoint(file_name, self.device), file_name)
+
+    def load_checkpoint_params(self, checkpoint, file_name):
+        if checkpoint["input_encoding_version"] != INPUT_ENCODING_VERSION:
+            raise ValueError(f"{file_name} was trained with the input encoding version "
+                             f"{checkpoint['input_encoding_version']}, the current version is {INPUT_ENCODING_VERSION}")
+        for key in ("model_config", "board_height", "board_width", "n_state_channels", "n_actions"):
+            if checkpoint[key] != getattr(self, key):
+                raise ValueError(f"{file_name} has {key} {checkpoint[key]}, the model has {getattr(self, key)}")
+        self.model.load_state_dict(checkpoint["state_dict"])
+        self.n_train_steps = checkpoint["train_step"]
+        self.inference_model = None
+
+    @classmethod
+    def from_checkpoint(cls, file_name, **kwargs):
+        """
+        Build the model described by a checkpoint and load its params, {kwargs}: the inference options
+        """
+        checkpoint = load_checkpoint(file_name, map_location="cpu")
+        policy_value_net = cls(checkpoint["board_height"], checkpoint["board_width"], checkpoint["n_state_channels"],
+                               checkpoint["n_actions"], model_config=checkpoint["model_config"], **kwargs)
+        policy_value_net.load_checkpoint_params(checkpoint, file_name)
+        return policy_value_net
+
+
+def load_cached_model(file_name, **kwargs):
+    """
+    Return the PolicyValueNet of a checkpoint (see PolicyValueNet.from_checkpoint), loaded by the first call and shared
+    by the next ones, until the checkpoint file is modified
+    """
+    key = (os.path.abspath(file_name), tuple(sorted(kwargs.items())))
+    mtime = os.path.getmtime(file_name)
+    with model_cache_lock:
+        if key not in model_cache or model_cache[key][0] != mtime:
+            model_cache[key] = (mtime, PolicyValueNet.from_checkpoint(file_name, **kwargs))
+        return model_cache[key][1]
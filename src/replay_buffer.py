@@ -0,0 +1,142 @@
+import numpy as np
+import torch
+from game_core.board import move_mirror_table
+
+
+# the arrays of a set of packed samples, see pack_samples()
+SAMPLE_FIELDS = ('planes', 'const_planes', 'policy_indices', 'policy_probs', 'winners')
+
+
+def pack_samples(play_data, max_policy_size=96, n_actions=192):
+    """
+    Pack a list of (eval state, mcts probs, winner z) compactly, as a dict of arrays:
+    - the eval state (pairs of the piece type planes of the player and of the opponent, then a constant plane,
+      see Board.get_eval_state) as one int8 plane per pair (+player types, -opponent types) and the constant
+    - the mcts probs as sparse float16 (index, prob) pairs, keeping the {max_policy_size} largest probs
+    - the winner z as int8
+    About 650 bytes per sample instead of 7.8 KB for the float64 arrays.
+    """
+    states, mcts_probs, winners = zip(*play_data)
+    states = np.asarray(states)
+    mcts_probs = np.asarray(mcts_probs, dtype=np.float16)
+    # the largest probs first, the padding has a 0 prob
+    indices = np.argsort(-mcts_probs, axis=1, kind='stable')[:, :max_policy_size]
+    return {
+        'planes': (states[:, 0:-1:2] - states[:, 1:-1:2]).astype(np.int8),
+        'const_planes': states[:, -1, 0, 0].astype(np.uint8),
+        'policy_indices': indices.astype(np.uint8 if n_actions < 256 else np.int16),
+        'policy_probs': np.take_along_axis(mcts_probs, indices, axis=1),
+        'winners': np.asarray(winners).astype(np.int8),
+    }
+
+
+class PackedBatcher:
+    def __init__(self, n_state_channels=9, board_height=10, board_width=9, n_actions=192, seed=None):
+        """
+        Unpacks mini-batches of packed samples into preallocated float32 arrays
+        """
+        self.n_state_channels = n_state_channels
+        self.board_shape = (board_height, board_width)
+        self.n_actions = n_actions
+        self.rng = np.random.default_rng(seed)
+        self.batch_size = None  # the size of the batch arrays below, allocated by the first get_batch()
+
+    def allocate_batch(self, batch_size):
+        """
+        Allocate the arrays of the batches, in pinned memory if they are to be copied to a GPU
+        """
+        def empty(shape):
+            return torch.empty(shape, dtype=torch.float32, pin_memory=torch.cuda.is_available()).numpy()
+        self.batch_size = batch_size
+        self.state_batch = empty((batch_size, self.n_state_channels) + self.board_shape)
+        self.probs_batch = empty((batch_size, self.n_actions))
+        self.winner_batch = empty((batch_size,))
+        # one more column, where the padding of the sparse probs is scattered
+        self.dense_probs = np.zeros((batch_size, self.n_actions + 1), dtype=np.float32)
+
+    def get_batch(self, packed, mirror=False):
+        """
+        Unpack a batch of packed samples, with each sample mirrored left-right with a 1/2 probability if {mirror}.
+        return: the state batch, the mcts probs batch and the winner batch, as contiguous float32 arrays
+        that are reused by the next call
+        """
+        planes = packed['planes']
+        batch_size = len(planes)
+        if batch_size != self.batch_size:
+            self.allocate_batch(batch_size)
+        indices = packed['policy_indices'].astype(np.intp)
+        probs = packed['policy_probs']
+        if mirror:
+            mirrored = self.rng.random(batch_size) < 0.5
+            planes[mirrored] = planes[mirrored, :, :, ::-1]
+            indices[mirrored] = move_mirror_table[indices[mirrored]]
+        indices[probs == 0] = self.n_actions
+        # unpack the planes
+        np.maximum(planes, 0, out=self.state_batch[:, 0:-1:2], casting='unsafe')
+        np.maximum(-planes, 0, out=self.state_batch[:, 1:-1:2], casting='unsafe')
+        self.state_batch[:, -1] = packed['const_planes'][:, None, None]
+        # scatter the probs, renormalized after the float16 rounding and the truncation
+        self.dense_probs.fill(0)
+        np.put_along_axis(self.dense_probs, indices, probs, axis=1)
+        self.probs_batch[:] = self.dense_probs[:, :self.n_actions]
+        self.probs_batch /= self.probs_batch.sum(axis=1, keepdims=True)
+        self.winner_batch[:] = packed['winners']
+        return self.state_batch, self.probs_batch, self.winner_batch
+
+
+class ReplayBuffer(PackedBatcher):
+    def __init__(self, capacity, n_state_channels=9, board_height=10, board_width=9, n_actions=192,
+                 max_policy_size=96, seed=None):
+        """
+        A preallocated ring buffer of packed self-play samples, see pack_samples()
+        """
+        super().__init__(n_state_channels, board_height, board_width, n_actions, seed)
+        self.capacity = capacity
+        self.max_policy_size = max_policy_size
+        n_state_pairs = (n_state_channels - 1) // 2
+        self.storage = {
+            'planes': np.zeros((capacity, n_state_pairs) + self.board_shape, dtype=np.int8),
+            'const_planes': np.zeros(capacity, dtype=np.uint8),
+            'policy_indices': np.zeros((capacity, max_policy_size), dtype=np.uint8 if n_actions < 256 else np.int16),
+            'policy_probs': np.zeros((capacity, max_policy_size), dtype=np.float16),
+            'winners': np.zeros(capacity, dtype=np.int8),
+        }
+        self.head = 0  # the slot of the next sample
+        self.size = 0
+
+    def __len__(self):
+        return self.size
+
+    def extend(self, play_data):
+        """
+        Append a list of (eval state, mcts probs, winner z), overwriting the oldest samples once full
+        """
+        play_data = list(play_data)
+        if play_data:
+            self.extend_packed(pack_samples(play_data, self.max_policy_size, self.n_actions))
+
+    def extend_packed(self, packed):
+        n_samples = len(packed['winners'])
+        if n_samples > self.capacity:
+            packed = {field: array[-self.capacity:] for field, array in packed.items()}
+            n_samples = self.capacity
+        slots = (self.head + np.arange(n_samples)) % self.capacity
+        for field in SAMPLE_FIELDS:
+            self.storage[field][slots] = packed[field]
+        self.head = (self.head + n_samples) % self.capacity
+        self.size = min(self.size + n_samples, self.capacity)
+
+    def get_last(self, n_samples):
+        """
+        The packed {n_samples} last samples, oldest first (e.g. to save the buffer with the training state)
+        """
+        n_samples = min(n_samples, self.size)
+        idx = (self.head - n_samples + np.arange(n_samples)) % self.capacity
+        return {field: array[idx] for field, array in self.storage.items()}
+
+    def sample(self, batch_size, mirror=False):
+        """
+        Sample a mini-batch (without replacement), see get_batch()
+        """
+        idx = self.rng.choice(self.size, batch_size, replace=False)
+        return self.get_batch({field: array[idx] for field, array in self.storage.items()}, mirror)
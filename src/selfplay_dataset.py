@@ -0,0 +1,108 @@
+import json
+import os
+import numpy as np
+from replay_buffer import SAMPLE_FIELDS, PackedBatcher, pack_samples
+
+
+class SelfPlayDataset(PackedBatcher):
+    def __init__(self, directory, shard_size=5000, n_state_channels=9, board_height=10, board_width=9, n_actions=192,
+                 max_policy_size=96, seed=None):
+        """
+        An append-only on-disk dataset of packed self-play samples (see pack_samples()).
+        The samples are written in shards of {shard_size} samples, one .npy file per field, listed in index.json;
+        the shards are memory-mapped to sample the training batches without loading them.
+        A dataset has a single writer, readers can pick up the new shards with refresh().
+        """
+        super().__init__(n_state_channels, board_height, board_width, n_actions, seed)
+        self.directory = directory
+        self.shard_size = shard_size
+        self.max_policy_size = max_policy_size
+        self.index_file = os.path.join(directory, 'index.json')
+        os.makedirs(directory, exist_ok=True)
+        self.shards = []  # a list of {'name', 'n_samples'}, in the order they were written
+        self.shard_arrays = []  # the memory-mapped fields of each shard
+        self.shard_offsets = np.zeros(1, dtype=np.int64)  # the index of the first sample of each shard, and the total
+        self.pending = []  # the packed samples not written yet
+        self.n_pending = 0
+        self.refresh()
+
+    def __len__(self):
+        """
+        The number of samples written to the disk
+        """
+        return int(self.shard_offsets[-1])
+
+    def refresh(self):
+        """
+        Load the shards added to the index since the last call
+        """
+        if not os.path.exists(self.index_file):
+            return
+        with open(self.index_file) as f:
+            shards = json.load(f)['shards']
+        for shard in shards[len(self.shards):]:
+            self.shard_arrays.append({field: np.load(self.get_shard_file(shard['name'], field), mmap_mode='r')
+                                      for field in SAMPLE_FIELDS})
+            self.shards.append(shard)
+        self.shard_offsets = np.concatenate([[0], np.cumsum([shard['n_samples'] for shard in self.shards])])
+
+    def get_shard_file(self, name, field):
+        return os.path.join(self.directory, f'{name}.{field}.npy')
+
+    def extend(self, play_data):
+        """
+        Append a list of (eval state, mcts probs, winner z), a shard is written every {shard_size} samples
+        """
+        play_data = list(play_data)
+        if play_data:
+            self.extend_packed(pack_samples(play_data, self.max_policy_size, self.n_actions))
+
+    def extend_packed(self, packed):
+        self.pending.append(packed)
+        self.n_pending += len(packed['winners'])
+        if self.n_pending >= self.shard_size:
+            self.flush()
+
+    def flush(self):
+        """
+        Write the pending samples as a new shard, then add it to the index
+        (the index is replaced atomically, so that a crash never leaves a partial shard in it)
+        """
+        if self.n_pending == 0:
+            return
+        name = f'shard_{len(self.shards):06d}'
+        for field in SAMPLE_FIELDS:
+            np.save(self.get_shard_file(name, field), np.concatenate([packed[field] for packed in self.pending]))
+        shards = self.shards + [{'name': name, 'n_samples': self.n_pending}]
+        self.pending = []
+        self.n_pending = 0
+        with open(self.index_file + '.tmp', 'w') as f:
+            json.dump({'shards': shards}, f, indent=1)
+        os.replace(self.index_file + '.tmp', self.index_file)
+        self.refresh()
+
+    def get_packed(self, idx):
+        """
+        Gather the packed samples at the (sorted) global indices {idx}, reading only these rows from the shards
+        """
+        shard_ids = np.searchsorted(self.shard_offsets, idx, side='right') - 1
+        parts = []
+        for shard_id in np.unique(shard_ids):
+            local_idx = idx[shard_ids == shard_id] - self.shard_offsets[shard_id]
+            parts.append({field: array[local_idx] for field, array in self.shard_arrays[shard_id].items()})
+        return {field: np.concatenate([part[field] for part in parts]) for field in SAMPLE_FIELDS}
+
+    def get_last(self, n_samples):
+        """
+        The packed {n_samples} last samples written (e.g. to refill a replay buffer after a restart)
+        """
+        n_samples = min(n_samples, len(self))
+        return self.get_packed(np.arange(len(self) - n_samples, len(self)))
+
+    def sample(self, batch_size, mirror=False, window=None):
+        """
+        Sample a mini-batch (without replacement) among the {window} last samples (None: all), see get_batch()
+        """
+        window = len(self) if window is None else min(window, len(self))
+        idx = np.sort(self.rng.choice(window, batch_size, replace=False)) + len(self) - window
+        return self.get_batch(self.get_packed(idx), mirror)
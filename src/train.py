@@ -1,17 +1,25 @@
+import os
+import queue
 import random
+import shutil
+import time
 import numpy as np
-from collections import defaultdict, deque
+import torch
+import torch.multiprocessing as mp
 from player.mcts_player import MCTSPlayer
 from player.policy_value_net import PolicyValueNet
 from game_core.board import *
+from arena import Arena
+from replay_buffer import ReplayBuffer, pack_samples
+from selfplay_dataset import SelfPlayDataset
 
 
 class SelfPlayGame:
-    def __init__(self):
-        pass
+    def __init__(self, board_backend="array"):
+        self.board_backend = board_backend
 
     def start_self_play(self, player, temp):
-        board = Board()
+        board = Board(backend=self.board_backend)
         board.init_board(0)
         states, mcts_probs, current_players = [], [], []
         current_player_id = 0
@@ -42,23 +50,67 @@ class SelfPlayGame:
                     print("Game end. Tie")
                 return winner, zip(states, mcts_probs, winners_z)
     
-    def start_eval_play(self, players):
-        board = Board()
-        board.init_board(0)
-        current_player_id = 0
+    def start_eval_play(self, players, board=None):
+        """
+        Play a game between 2 players (players[i] plays the player id i), from the initial position or from {board}
+        return: the winner, -1: tie
+        """
+        if board is None:
+            board = Board(backend=self.board_backend)
+            board.init_board(0)
+        current_player_id = board.cur_player
 
         while True:
             player_in_turn = players[current_player_id]
             piece_id, coord = player_in_turn.get_action(board, current_player_id)  # player take action
+            move = board.encode_move(piece_id, coord)
             board.move_piece(piece_id, coord)  # update board state
+            players[1 - current_player_id].notify_move(move)  # let the opponent reuse its search tree
             game_finished, winner = board.game_finished()  # check game finished
             if game_finished:
                 players[0].reset_player()
                 players[1].reset_player()
-                break
+                return winner
             current_player_id = 1 - current_player_id  # switch the player
             
 
+def self_play_worker(worker_id, config, param_queue, data_queue):
+    """
+    Self-play worker process: keeps playing games with the latest policy params received from {param_queue},
+    and sends the play data of each game back through {data_queue}. A None in {param_queue} stops the worker.
+    """
+    torch.set_num_threads(1)  # one core per worker
+    np.random.seed(config['seed'] + worker_id)
+    random.seed(config['seed'] + worker_id)
+    policy_value_net = PolicyValueNet(config['board_height'], config['board_width'],
+                                      config['n_state_channels'], config['n_actions'],
+                                      model_config=config['model_config'])
+    mcts_player = MCTSPlayer(policy_value_net.policy_value_fn,
+                             player_id=0, name=f"worker{worker_id}", c=config['c_puct'],
+                             n_simulations=config['n_simulations'], is_training=True,
+                             batch_size=config['mcts_batch_size'],
+                             policy_value_batch_fn=policy_value_net.policy_value_batch_fn,
+                             eval_cache_size=config['eval_cache_size'])
+    self_play_game = SelfPlayGame(config['board_backend'])
+    policy_param = param_queue.get()  # wait for the initial params
+    loaded_policy_param = None
+    while policy_param is not None:
+        if policy_param is not loaded_policy_param:
+            policy_value_net.load_policy_param(policy_param)
+            mcts_player.clear_eval_cache()
+            loaded_policy_param = policy_param
+        winner, play_data = self_play_game.start_self_play(mcts_player, config['temp'])
+        data_queue.put((worker_id, winner, list(play_data)))
+        # pick up the newest params published after the last policy update, if any
+        try:
+            while True:
+                policy_param = param_queue.get_nowait()
+                if policy_param is None:
+                    break
+        except queue.Empty:
+            pass
+
+
 class TrainPipeline():
     def __init__(self):
         # params of the board and the game
@@ -66,46 +118,218 @@ class TrainPipeline():
         self.board_height = 10
         self.n_state_channels = 9
         self.n_actions = 192
-        self.self_play_game = SelfPlayGame()
+        # the architecture of the policy value net, e.g. {"arch": "resnet", "n_blocks": 6, "n_filters": 64, "se": True}
+        self.model_config = {"arch": "chessnet"}
+        self.board_backend = "array"  # "array" or "bitboard" move generation
+        self.self_play_game = SelfPlayGame(self.board_backend)
         # training params
         self.learn_rate = 2e-3
         self.lr_multiplier = 1.0  # adaptively adjust the learning rate based on KL
         self.temp = 1.0  # the temperature param
         self.n_simulations = 200  # num of simulations for each move
         self.c_puct = 5
-        self.buffer_size = 10000
+        self.mcts_batch_size = 8  # num of leaves evaluated together in each MCTS round
+        self.eval_cache_size = 20000  # num of network evaluations cached by the MCTS
+        self.buffer_size = 200000  # num of samples in the replay buffer (~650 bytes each)
         self.batch_size = 512  # mini-batch size for training
-        self.data_buffer = deque(maxlen=self.buffer_size)
+        self.mirror_augment = True  # mirror the sampled positions left-right at random
+        self.data_buffer = ReplayBuffer(self.buffer_size, self.n_state_channels, self.board_height, self.board_width,
+                                        self.n_actions)
+        self.dataset_dir = 'data/selfplay'  # all the self-play games are kept there, None: not kept
+        self.dataset = None
+        self.dataset_shard_size = 5000  # num of samples of a shard, the samples are written (and trainable) by shard
+        # sample the mini-batches from the whole on-disk dataset (memory-mapped) instead of the replay buffer,
+        # among its {dataset_window} last samples (None: all)
+        self.train_from_dataset = False
+        self.dataset_window = 2000000
         self.play_batch_size = 1
+        self.n_selfplay_workers = 0  # num of self-play worker processes, 0: play in the trainer process
+        self.selfplay_queue_size = 8  # max num of finished games waiting for the trainer, the workers wait beyond
+        # pipelined training (needs self-play workers): the policy is updated while the workers keep playing,
+        # each update waits only for enough new positions to keep the num of sampled positions
+        # under {sample_reuse} times the num of generated positions
+        self.pipelined = False
+        self.sample_reuse = 4.0
+        self.selfplay_workers = []
         self.epochs = 5  # num of train_steps for each update
         self.kl_targ = 0.02
         self.check_freq = 30
         self.game_batch_num = 100
-        self.best_win_ratio = 0.0
-        self.policy_value_net = PolicyValueNet(self.board_width, self.board_height, 
-                                               self.n_state_channels, self.n_actions)
+        # evaluation params: the current policy plays the best policy so far in a background arena
+        self.n_eval_games = 100
+        self.n_arena_workers = 2
+        self.gating_score = 0.55  # min score of the current policy to become the best policy
+        self.current_model_file = 'models/current_policy.model'
+        self.best_model_file = 'models/best_policy.model'
+        # resume: restart from the training state saved by the last run (model, optimizer, lr multiplier, replay buffer,
+        # batch index), or warm-start the model from {current_model_file} if there is none
+        self.resume = True
+        self.train_state_file = 'models/train_state.pt'
+        self.start_batch = 0  # the index of the first batch (or update) of run(), set by load_train_state()
+        self.n_batches = 0  # num of batches (or updates) done
+        self.arena = None
+        self.arena_model_file = None  # the checkpoint of the current policy playing in the arena
+        self.policy_value_net = PolicyValueNet(self.board_height, self.board_width,
+                                               self.n_state_channels, self.n_actions, model_config=self.model_config)
         self.mcts_player = MCTSPlayer(self.policy_value_net.policy_value_fn,
                                       player_id=0, name="bot1", c=self.c_puct,
-                                      n_simulations=self.n_simulations, is_training=True)
+                                      n_simulations=self.n_simulations, is_training=True,
+                                      batch_size=self.mcts_batch_size,
+                                      policy_value_batch_fn=self.policy_value_net.policy_value_batch_fn,
+                                      eval_cache_size=self.eval_cache_size)
+
+    def start_selfplay_workers(self):
+        """
+        start the self-play worker processes, each playing with a snapshot of the current policy params
+        """
+        ctx = mp.get_context("spawn")
+        config = {
+            'board_width': self.board_width,
+            'board_height': self.board_height,
+            'n_state_channels': self.n_state_channels,
+            'n_actions': self.n_actions,
+            'model_config': self.policy_value_net.model_config,
+            'board_backend': self.board_backend,
+            'c_puct': self.c_puct,
+            'n_simulations': self.n_simulations,
+            'mcts_batch_size': self.mcts_batch_size,
+            'eval_cache_size': self.eval_cache_size,
+            'temp': self.temp,
+            'seed': random.randrange(2 ** 31),
+        }
+        self.selfplay_data_queue = ctx.Queue(maxsize=self.selfplay_queue_size)
+        policy_param = self.policy_value_net.get_policy_param()
+        for worker_id in range(self.n_selfplay_workers):
+            param_queue = ctx.Queue()
+            param_queue.put(policy_param)
+            worker = ctx.Process(target=self_play_worker, args=(worker_id, config, param_queue, self.selfplay_data_queue),
+                                 daemon=True)
+            worker.start()
+            self.selfplay_workers.append((worker, param_queue))
+
+    def publish_policy_param(self):
+        """
+        send the updated policy params to the self-play workers, they pick them up before their next game
+        """
+        policy_param = self.policy_value_net.get_policy_param()
+        for _, param_queue in self.selfplay_workers:
+            param_queue.put(policy_param)
+
+    def stop_selfplay_workers(self):
+        for _, param_queue in self.selfplay_workers:
+            param_queue.put(None)
+        while self.selfplay_workers and self.receive_selfplay_data() > 0:
+            pass  # let the workers waiting for a room in the queue finish their game
+        for worker, _ in self.selfplay_workers:
+            worker.join(timeout=10)
+            if worker.is_alive():
+                worker.terminate()
+        self.selfplay_workers = []
 
     def collect_selfplay_data(self, n_games=1):
         """
         collect self-play data for training
         """
+        if self.selfplay_workers:
+            # wait for {n_games} games, then take whatever else the workers have finished meanwhile
+            n_collected = 0
+            while self.receive_selfplay_data(block=n_collected < n_games) > 0:
+                n_collected += 1
+            return
         for i in range(n_games):
             winner, play_data = self.self_play_game.start_self_play(self.mcts_player, self.temp)
             play_data = list(play_data)[:]
             self.episode_len = len(play_data)
-            self.data_buffer.extend(play_data)
+            self.store_play_data(play_data)
+
+    def receive_selfplay_data(self, block=False):
+        """
+        store the play data of a game finished by a self-play worker, return its num of positions (0: no game finished)
+        """
+        try:
+            worker_id, winner, play_data = self.selfplay_data_queue.get(block=block)
+        except queue.Empty:
+            return 0
+        self.episode_len = len(play_data)
+        self.store_play_data(play_data)
+        return len(play_data)
+
+    def store_play_data(self, play_data):
+        packed = pack_samples(play_data, self.data_buffer.max_policy_size, self.n_actions)
+        self.data_buffer.extend_packed(packed)
+        if self.dataset is not None:
+            self.dataset.extend_packed(packed)
+
+    def load_dataset(self):
+        """
+        open the self-play dataset, and refill the replay buffer with its last samples (when restarting a training)
+        """
+        if self.dataset_dir is None:
+            return
+        self.dataset = SelfPlayDataset(self.dataset_dir, self.dataset_shard_size, n_state_channels=self.n_state_channels,
+                                       board_height=self.board_height, board_width=self.board_width,
+                                       n_actions=self.n_actions, max_policy_size=self.data_buffer.max_policy_size)
+        if len(self.dataset) > 0 and len(self.data_buffer) == 0:
+            self.data_buffer.extend_packed(self.dataset.get_last(self.buffer_size))
+            print(f"loaded {len(self.data_buffer)} samples from {self.dataset_dir} ({len(self.dataset)} samples)")
+
+    def get_n_train_samples(self):
+        """
+        num of samples the mini-batches are sampled from
+        """
+        if self.train_from_dataset:
+            return len(self.dataset) if self.dataset_window is None else min(len(self.dataset), self.dataset_window)
+        return len(self.data_buffer)
+
+    def save_train_state(self):
+        """
+        save everything needed to resume the training: the model checkpoint, the optimizer state, the lr multiplier,
+        the replay buffer and the batch index
+        (written to a temporary file first, so that a crash never leaves a partial state)
+        """
+        train_state = {
+            'model': self.policy_value_net.get_checkpoint(),
+            'optimizer': self.policy_value_net.optimizer.state_dict(),
+            'lr_multiplier': self.lr_multiplier,
+            'n_batches': self.n_batches,
+            'data_buffer': {field: torch.from_numpy(array)
+                            for field, array in self.data_buffer.get_last(len(self.data_buffer)).items()},
+        }
+        torch.save(train_state, self.train_state_file + '.tmp')
+        os.replace(self.train_state_file + '.tmp', self.train_state_file)
+
+    def load_train_state(self):
+        """
+        resume from the training state saved by save_train_state(),
+        or only load the params of {current_model_file} (e.g. a model trained before the training states were saved)
+        """
+        if os.path.exists(self.train_state_file):
+            # the replay buffer stays on the cpu, the params and the optimizer state are copied to the model's device
+            train_state = torch.load(self.train_state_file, map_location="cpu")
+            self.policy_value_net.load_checkpoint_params(train_state['model'], self.train_state_file)
+            self.policy_value_net.optimizer.load_state_dict(train_state['optimizer'])
+            self.lr_multiplier = train_state['lr_multiplier']
+            self.start_batch = self.n_batches = train_state['n_batches']
+            self.data_buffer.extend_packed({field: tensor.numpy() for field, tensor in train_state['data_buffer'].items()})
+            print(f"resumed from {self.train_state_file}: batch {self.n_batches}, "
+                  f"lr_multiplier: {self.lr_multiplier:.3f}, {len(self.data_buffer)} samples")
+        elif os.path.exists(self.current_model_file):
+            try:
+                self.policy_value_net.load_model(self.current_model_file)
+            except ValueError as e:
+                print(f"not warm-starting from {self.current_model_file}: {e}")
+                return
+            print(f"warm-started from {self.current_model_file}")
 
     def policy_update(self):
         """
         update the policy-value net
         """
-        mini_batch = random.sample(self.data_buffer, self.batch_size)
-        state_batch = np.array([data[0] for data in mini_batch])
-        mcts_probs_batch = np.array([data[1] for data in mini_batch])
-        winner_batch = np.array([data[2] for data in mini_batch])
+        if self.train_from_dataset:
+            state_batch, mcts_probs_batch, winner_batch = self.dataset.sample(self.batch_size, self.mirror_augment,
+                                                                              self.dataset_window)
+        else:
+            state_batch, mcts_probs_batch, winner_batch = self.data_buffer.sample(self.batch_size, self.mirror_augment)
         old_probs, old_v = self.policy_value_net.policy_value(state_batch)
         for i in range(self.epochs):
             loss, entropy = self.policy_value_net.train_step(
@@ -123,8 +347,8 @@ class TrainPipeline():
         elif kl < self.kl_targ / 2 and self.lr_multiplier < 10:
             self.lr_multiplier *= 1.5
 
-        explained_var_old = (1 - np.var(np.array(winner_batch) - old_v.flatten()) / np.var(np.array(winner_batch)))
-        explained_var_new = (1 - np.var(np.array(winner_batch) - new_v.flatten()) / np.var(np.array(winner_batch)))
+        explained_var_old = (1 - np.var(winner_batch - old_v.flatten()) / np.var(winner_batch))
+        explained_var_new = (1 - np.var(winner_batch - new_v.flatten()) / np.var(winner_batch))
         print(f"kl:{kl:.5f}\n"
               f"lr_multiplier:{self.lr_multiplier:.3f}\n"
               f"loss:{loss}\n"
@@ -133,54 +357,125 @@ class TrainPipeline():
               f"explained_var_new:{explained_var_new:.3f}\n")
         return loss, entropy
 
-    def policy_evaluate(self, n_games=10):
+    def policy_evaluate(self, i):
         """
-        Evaluate the trained policy by playing against the pure MCTS player
-        Note: this is only for monitoring the progress of training
+        Save the current policy, and start a match against the best policy in a background arena
+        (unless the previous match is still going on), so that the training loop doesn't wait for it
         """
-        current_mcts_player = MCTSPlayer(self.policy_value_net.policy_value_fn,
-                                         player_id=0, name="bot1", c=self.c_puct,
-                                         n_simulations=self.n_simulations)
-        
-        dumb_net = PolicyValueNet(self.board_width, self.board_height, self.n_state_channels, self.n_actions)
-        dumb_player = MCTSPlayer(dumb_net.policy_value_fn, player_id=1, name="bot2", n_simulations=10)
-        
-        win_cnt = defaultdict(int)
-        for i in range(n_games):
-            winner = self.self_play_game.start_eval_play([current_mcts_player, dumb_player])
-            win_cnt[winner] += 1
-        win_ratio = 1.0*(win_cnt[1] + 0.5*win_cnt[-1]) / n_games
-        print(f"win: {win_cnt[1]}, lose: {win_cnt[2]}, tie:{win_cnt[-1]}")
-        return win_ratio
+        self.policy_value_net.save_model(self.current_model_file)
+        self.save_train_state()
+        if self.arena is not None:
+            return
+        if not os.path.exists(self.best_model_file):
+            print("New best policy!!!!!!!!")
+            shutil.copyfile(self.current_model_file, self.best_model_file)
+            return
+        # freeze the checkpoint playing in the arena, the current policy keeps being saved meanwhile
+        self.arena_model_file = f'models/candidate_policy_{i}.model'
+        shutil.copyfile(self.current_model_file, self.arena_model_file)
+        self.arena = Arena(self.arena_model_file, self.best_model_file, n_games=self.n_eval_games,
+                           n_workers=self.n_arena_workers, n_simulations=self.n_simulations, c_puct=self.c_puct,
+                           mcts_batch_size=self.mcts_batch_size, results_file=f'models/arena_{i}.jsonl',
+                           board_backend=self.board_backend)
+        self.arena.start()
+
+    def check_arena(self, block=False):
+        """
+        Collect the results of the background arena, and promote the candidate policy if it beat the best policy
+        """
+        if self.arena is None or not self.arena.poll(block):
+            return
+        summary = self.arena.get_summary()
+        print(f"arena: win: {summary['wins']}, lose: {summary['losses']}, tie: {summary['draws']}, "
+              f"score: {summary['score']:.3f} {summary['score_ci']}, elo: {summary['elo']:.0f} {summary['elo_ci']}")
+        if summary['score'] >= self.gating_score:
+            print("New best policy!!!!!!!!")
+            shutil.copyfile(self.arena_model_file, self.best_model_file)
+        os.remove(self.arena_model_file)
+        self.arena = None
 
     def run(self):
         """
         run the training pipeline
         """
+        if self.pipelined and self.n_selfplay_workers == 0:
+            raise ValueError("the pipelined training needs self-play workers")
+        if self.train_from_dataset and self.dataset_dir is None:
+            raise ValueError("the training from the dataset needs a dataset_dir")
         try:
-            for i in range(self.game_batch_num):
-                print(f"========== Batch {i} ==========")
-                print("start self-playing...")
-                self.collect_selfplay_data(self.play_batch_size)
-                print(f"batch i:{i+1}, episode_len:{self.episode_len}\n")
-                if len(self.data_buffer) > self.batch_size:
-                    print("start training step...")
-                    loss, entropy = self.policy_update()
-                # check the performance of the current model, and save the model params
-                if (i + 1) % self.check_freq == 0:
-                    print(f"current self-play batch: {i+1}")
-                    win_ratio = self.policy_evaluate()
-                    self.policy_value_net.save_model('models/current_policy.model')
-                    if win_ratio > self.best_win_ratio:
-                        print("New best policy!!!!!!!!")
-                        self.best_win_ratio = win_ratio
-                        # update the best_policy
-                        self.policy_value_net.save_model('models/best_policy.model')
-                        if (self.best_win_ratio == 1.0 and self.pure_mcts_playout_num < 5000):
-                            self.pure_mcts_playout_num += 1000
-                            self.best_win_ratio = 0.0
+            if self.resume:
+                self.load_train_state()
+            self.load_dataset()
+            if self.n_selfplay_workers > 0:
+                self.start_selfplay_workers()
+            if self.pipelined:
+                self.run_pipelined()
+            else:
+                self.run_sequential()
+            self.check_arena(block=True)
         except KeyboardInterrupt:
             print('\n\rquit')
+        finally:
+            self.stop_selfplay_workers()
+            if self.dataset is not None:
+                self.dataset.flush()
+            if self.n_batches > self.start_batch:
+                self.save_train_state()
+            if self.arena is not None:
+                self.arena.stop()
+
+    def run_sequential(self):
+        """
+        alternate the self-play of {play_batch_size} games and a policy update
+        """
+        for i in range(self.start_batch, self.game_batch_num):
+            print(f"========== Batch {i} ==========")
+            print("start self-playing...")
+            self.collect_selfplay_data(self.play_batch_size)
+            print(f"batch i:{i+1}, episode_len:{self.episode_len}\n")
+            if self.get_n_train_samples() > self.batch_size:
+                print("start training step...")
+                loss, entropy = self.policy_update()
+                self.mcts_player.clear_eval_cache()
+                self.publish_policy_param()
+            # check the performance of the current model, and save the model params
+            self.check_arena()
+            if (i + 1) % self.check_freq == 0:
+                print(f"current self-play batch: {i+1}")
+                self.policy_evaluate(i + 1)
+            self.n_batches = i + 1
+
+    def run_pipelined(self):
+        """
+        run {game_batch_num} policy updates while the self-play workers keep playing (and the arena keeps evaluating),
+        an update waits for new positions only when the sample reuse would exceed {sample_reuse}
+        (the samples reloaded when restarting don't count as generated, the updates wait for fresh games as well)
+        """
+        n_reloaded = len(self.data_buffer)
+        n_generated = 0  # num of positions generated by this run
+        n_consumed = 0
+        print(f"{n_reloaded} samples reloaded")
+        start_time = time.time()
+        for i in range(self.start_batch, self.game_batch_num):
+            while self.get_n_train_samples() <= self.batch_size \
+                    or n_consumed + self.batch_size > self.sample_reuse * n_generated:
+                n_generated += self.receive_selfplay_data(block=True)
+            while True:  # take whatever else the workers have finished meanwhile
+                n_positions = self.receive_selfplay_data()
+                if n_positions == 0:
+                    break
+                n_generated += n_positions
+            print(f"========== Update {i} ==========")
+            loss, entropy = self.policy_update()
+            n_consumed += self.batch_size
+            self.publish_policy_param()
+            elapsed = time.time() - start_time
+            print(f"positions/sec generated: {n_generated / elapsed:.1f}, consumed: {n_consumed / elapsed:.1f}, "
+                  f"sample reuse (of the generated positions): {n_consumed / n_generated:.2f}\n")
+            self.check_arena()
+            if (i + 1) % self.check_freq == 0:
+                self.policy_evaluate(i + 1)
+            self.n_batches = i + 1
 
 
 if __name__ == '__main__':